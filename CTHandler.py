@@ -1,14 +1,31 @@
 import numpy as np
 import scipy.ndimage
+import scipy.special
 import nibabel as nib
 import os, shutil
+import argparse
+import csv
+import glob
+import hashlib
+import inspect
+import itertools
+import json
+import resource
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
 from datetime import datetime
+from functools import lru_cache
 import sys
 
 
 AXIS_NAMES = ["axial", "coronal", "sagital"]
 image_format = '.jpg'
+IMAGE_FORMATS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+US_MASK = (0.35, 0.5, 0.3, 0.65, 0.35, 0.7)  # (sx, ex, sy, ey, sz, ez) fractions of the MITK-oriented volume
 
 
 def timestamp():
@@ -37,16 +54,32 @@ def get_axis_index(axis, numerical=True):
     else:
         return axis
     
-def save_image(data, dest):    
-    Image.fromarray(data.astype(np.uint8)).save(dest)
+def save_image(data, dest, **save_kwargs):    
+    Image.fromarray(data.astype(np.uint8)).save(dest, **save_kwargs)
     
 def normalise_image(data, vmin=0, vmax=100):
     data = ((data - vmin)/(vmax - vmin))*255
     data = data*(data >= 0)*(data <= 255)
     return data
 
-def rotate_image(data, angle, axes=(0,1)):
-    return scipy.ndimage.rotate(data, angle, axes=axes, reshape=True, output=None, order=1, mode='constant', cval=0.0, prefilter=True)   
+@lru_cache(maxsize=8)
+def window_lut(vmin, vmax):
+    """Return the uint8 <normalise_image> of every int16 value, indexed by its uint16 bit pattern."""
+    hu = np.arange(2**16, dtype=np.uint16).view(np.int16)
+    return normalise_image(hu.astype(np.float64), vmin, vmax).astype(np.uint8)
+
+def window_image(data, vmin=0, vmax=100):
+    """uint8 equivalent of <normalise_image> for int16 HU data, as a single lookup table gather."""
+    return window_lut(vmin, vmax)[data.view(np.uint16)]
+
+def as_hu(data):
+    """Round and clip scaled voxel values to int16 Hounsfield units."""
+    if data.dtype == np.int16:
+        return data
+    return np.clip(np.rint(data), -2**15, 2**15-1).astype(np.int16)
+
+def rotate_image(data, angle, axes=(0,1), output=None):
+    return scipy.ndimage.rotate(data, angle, axes=axes, reshape=True, output=output, order=1, mode='constant', cval=0.0, prefilter=True)   
 
 def draw_line(data, axis, index, color):
     if data.ndim == 2 and len(color) == 3:
@@ -63,24 +96,149 @@ def draw_line(data, axis, index, color):
     
     return data
         
-def extract_all_slices(data, axis, in_file, dest_folder, step=1):    
+class SliceWriter():
+    """Encode and save slices as <identifier>-<index>.<ext> images in <dest_folder>.
+
+    Slices are encoded on a pool of <threads> threads (0: encode on the calling thread).
+    At most <max_pending> slices are queued: <write> waits for the oldest one beyond that, so memory
+    stays bounded and slices complete in submission order. <quality> is the JPEG/WebP quality or
+    the PNG compression level.
+    """
+
+    def __init__(self, dest_folder, fmt='jpeg', quality=None, threads=4, max_pending=64):
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError('%s is not a valid image format, expected one of %s.' % (fmt, list(IMAGE_FORMATS)))
+        if not os.path.exists(dest_folder):
+            os.mkdir(dest_folder)
+        self.dest_folder = dest_folder
+        self.extension = IMAGE_FORMATS[fmt]
+        self.save_kwargs = {}
+        if quality is not None:
+            self.save_kwargs = {'compress_level': quality} if fmt == 'png' else {'quality': quality}
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self.max_pending = max_pending
+        self.pending = deque()
+
+    def save(self, identifier, index, data):
+        dest = os.path.join(self.dest_folder, identifier+"-"+to_str(index,3)+self.extension)
+        save_image(data, dest, **self.save_kwargs)
+        return dest
+
+    def write(self, identifier, index, data):
+        """Queue one slice and return the Future of its destination path."""
+        if self.pool is None:
+            future = Future()
+            try:
+                future.set_result(self.save(identifier, index, data))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().exception()  # wait, errors are reported through the returned futures
+        # copy the slice so that a queued view does not keep the whole volume alive
+        future = self.pool.submit(self.save, identifier, index, np.array(data))
+        self.pending.append(future)
+        return future
+
+    def flush(self):
+        """Wait for every queued slice."""
+        while self.pending:
+            self.pending.popleft().exception()
+
+    def close(self):
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+class ShardWriter(SliceWriter):
+    """Append slices to a few large raw uint8 shard files instead of writing one image per slice.
+
+    Slices are appended to <dest_folder>/shard-<tag>-<n>.bin, a new shard being started once the
+    current one would exceed <shard_bytes>. Every slice adds an
+    "identifier,index,shard,offset,height,width,stamp" row to <dest_folder>/index-<tag>.csv, which is
+    what data/image_folder.py reads back. <stamp> is the time (ns) this writer started writing the
+    volume: when a volume is processed again, the loader keeps the slices of its latest stamp only,
+    whatever the index files they are in. The files are flushed once per volume. Slices are written by a single background thread, so they
+    stay ordered. <tag> defaults to the process id so that pool workers never share a file.
+    """
+
+    def __init__(self, dest_folder, shard_bytes=2**30, tag=None, max_pending=64):
+        SliceWriter.__init__(self, dest_folder, threads=1, max_pending=max_pending)
+        self.tag = str(os.getpid()) if tag is None else tag
+        self.shard_bytes = shard_bytes
+        self.shard_id = max(len(glob.glob(os.path.join(dest_folder, 'shard-%s-*.bin' % self.tag))) - 1, 0)
+        self.shard = None
+        self.index_file = open(os.path.join(dest_folder, 'index-%s.csv' % self.tag), 'a', newline='')
+        self.index = csv.writer(self.index_file)
+        self.stamps = {}
+
+    def save(self, identifier, index, data):
+        data = np.ascontiguousarray(data, dtype=np.uint8)
+        if self.stamps and identifier not in self.stamps:
+            # a new volume: make the previous one's slices and rows durable, so a writer killed
+            # in the middle of a volume only leaves that volume's rows incomplete
+            self.flush_files()
+        if self.shard is not None and 0 < self.shard.tell() and self.shard.tell() + data.nbytes > self.shard_bytes:
+            self.shard.close()
+            self.shard = None
+            self.shard_id += 1
+        if self.shard is None:
+            self.shard = open(os.path.join(self.dest_folder, 'shard-%s-%05d.bin' % (self.tag, self.shard_id)), 'ab')
+        offset = self.shard.tell()
+        self.shard.write(data.tobytes())
+        stamp = self.stamps.setdefault(identifier, time.time_ns())
+        self.index.writerow([identifier, index, os.path.basename(self.shard.name), offset, data.shape[0], data.shape[1], stamp])
+        return self.shard.name
+
+    def flush_files(self):
+        # shard data first, so that flushed rows never point past the end of their shard
+        if self.shard is not None:
+            self.shard.flush()
+        self.index_file.flush()
+
+    def flush(self):
+        SliceWriter.flush(self)
+        self.flush_files()
+
+    def close(self):
+        SliceWriter.close(self)
+        if self.shard is not None:
+            self.shard.close()
+        self.index_file.close()
+
+def get_writer(dest_folder, fmt='jpeg', shard_bytes=2**30, **options):
+    """Return a <ShardWriter> when <fmt> is 'shard' (image-only options are ignored), a <SliceWriter> otherwise."""
+    if fmt == 'shard':
+        return ShardWriter(dest_folder, shard_bytes=shard_bytes, max_pending=options.get('max_pending', 64))
+    return SliceWriter(dest_folder, fmt, **options)
+
+def extract_all_slices(data, axis, in_file, dest_folder, step=1, writer=None, offset=0):
+    """Save the slices of <data> along <axis> and return the Futures of their paths.
+
+    Without <writer>, slices are saved synchronously as JPEGs in <dest_folder>.
+    Slices are numbered from <offset>, for <data> holding a slab of a larger volume.
+    """
     index = get_axis_index(axis)
     axis  = get_axis_index(axis, False)
     
-    axis_folder = os.path.join(dest_folder)
-    if not os.path.exists(axis_folder):
-        os.mkdir(axis_folder)
+    own_writer = writer is None
+    if own_writer:
+        writer = SliceWriter(dest_folder, threads=0)
     
     identifier = os.path.split(in_file)[1][10:14]
     
+    futures = []
     for i in range(0,data.shape[index],step):
-        dest = os.path.join(axis_folder, identifier+"-"+to_str(i,3)+image_format)
         if index == 0:
-            save_image(data[i,:,:], dest)
+            futures.append(writer.write(identifier, offset+i, data[i,:,:]))
         elif index == 1:
-            save_image(data[:,i,:], dest)
+            futures.append(writer.write(identifier, offset+i, data[:,i,:]))
         elif index == 2:
-            save_image(data[:,:,i], dest)
+            futures.append(writer.write(identifier, offset+i, data[:,:,i]))
+    
+    if own_writer:
+        writer.close()
+    return futures
 
 def copy_mitk_coodinates(data):
     data = np.rot90(data, k=1, axes=(1,2))
@@ -94,16 +252,206 @@ def affine_scaling(data, coefs):
     affine_scale = coefs/coefs.min() # min value becomes 1 => no data loss
     return scipy.ndimage.zoom(data, affine_scale, order=1)
 
-def deform_to_US(data, a, b, c):
+class TransformChain():
+    """Compose rotations, rot90s, flips and scalings of a 3D volume into a single resampling.
+
+    Each step is recorded as a homogeneous matrix mapping output voxel coordinates to input voxel
+    coordinates, with the same output shape and centering as the corresponding numpy/scipy call
+    (np.rot90, np.flip, scipy.ndimage.rotate with reshape=True, scipy.ndimage.zoom). The output
+    shape is therefore known before any data is touched, and <apply> interpolates only once.
+    """
+
+    def __init__(self, shape):
+        self.in_shape = tuple(int(n) for n in shape)
+        self.shape = self.in_shape
+        self.matrix = np.eye(len(shape)+1)
+
+    def _push(self, step, shape):
+        self.matrix = self.matrix @ step
+        self.shape = tuple(int(n) for n in shape)
+        return self
+
+    def rotate(self, angle, axes=(0,1)):
+        """Same as rotate_image(data, angle, axes)."""
+        a0, a1 = sorted(axes)
+        c, s = scipy.special.cosdg(angle), scipy.special.sindg(angle)
+        rot = np.array([[c, s], [-s, c]])
+        in_plane = np.array([self.shape[a0], self.shape[a1]])
+        corners = rot @ [[0, 0, in_plane[0], in_plane[0]], [0, in_plane[1], 0, in_plane[1]]]
+        out_plane = (np.ptp(corners, axis=1) + 0.5).astype(int)
+        offset = (in_plane-1)/2 - rot @ ((out_plane-1)/2)
+
+        step = np.eye(len(self.shape)+1)
+        step[np.ix_([a0, a1], [a0, a1])] = rot
+        step[[a0, a1], -1] = offset
+        shape = list(self.shape)
+        shape[a0], shape[a1] = out_plane
+        return self._push(step, shape)
+
+    def rot90(self, k=1, axes=(0,1)):
+        """Same as np.rot90(data, k, axes)."""
+        a0, a1 = axes
+        for _ in range(k % 4):
+            step = np.zeros((len(self.shape)+1,)*2)
+            for a in range(len(self.shape)+1):
+                if a not in axes:
+                    step[a, a] = 1
+            step[a0, a1] = 1
+            step[a1, a0] = -1
+            step[a1, -1] = self.shape[a1]-1
+            shape = list(self.shape)
+            shape[a0], shape[a1] = shape[a1], shape[a0]
+            self._push(step, shape)
+        return self
+
+    def flip(self, axis):
+        """Same as np.flip(data, axis)."""
+        step = np.eye(len(self.shape)+1)
+        step[axis, axis] = -1
+        step[axis, -1] = self.shape[axis]-1
+        return self._push(step, self.shape)
+
+    def mitk(self):
+        """Same as copy_mitk_coodinates(data)."""
+        return self.rot90(1, (1,2)).rot90(3, (0,1)).rot90(1, (1,2)).flip(2)
+
+    def scale(self, coefs):
+        """Same as affine_scaling(data, coefs)."""
+        coefs = np.array(coefs, dtype=np.float64)
+        zoom = coefs/coefs.min()
+        shape = [int(round(n*z)) for n, z in zip(self.shape, zoom)]
+        step = np.eye(len(self.shape)+1)
+        for a, (n_in, n_out) in enumerate(zip(self.shape, shape)):
+            step[a, a] = (n_in-1)/(n_out-1) if n_out > 1 else 1
+        return self._push(step, shape)
+
+    def apply(self, data, order=1, output=None, cval=0.0):
+        """Resample <data> (of the chain's input shape) in a single affine_transform pass."""
+        assert tuple(data.shape) == self.in_shape, 'expected a volume of shape %s, got %s' % (self.in_shape, data.shape)
+        return scipy.ndimage.affine_transform(data, self.matrix, output_shape=self.shape, output=output, order=order,
+                                              mode='constant', cval=cval, prefilter=True)
+
+    def slab_source(self, start, stop, halo=1):
+        """Return the input slices read by the output slices <start>:<stop> along axis 0.
+
+        The output slab is a box, so the input voxels it samples lie in the bounding box of its
+        corners mapped through the matrix, grown by <halo> voxels for the interpolation support
+        and clipped to the input shape.
+        """
+        ranges = [[start, stop-1]] + [[0, n-1] for n in self.shape[1:]]
+        corners = np.array(list(itertools.product(*ranges)), dtype=np.float64)
+        points = corners @ self.matrix[:-1, :-1].T + self.matrix[:-1, -1]
+        lo = np.maximum(np.floor(points.min(axis=0)).astype(int) - halo, 0)
+        hi = np.minimum(np.ceil(points.max(axis=0)).astype(int) + halo + 1, self.in_shape)
+        return tuple(slice(int(l), int(max(l, h))) for l, h in zip(lo, hi))
+
+    def apply_slab(self, read, start, stop, order=1, output=None, cval=0.0):
+        """Resample the output slices <start>:<stop> along axis 0, reading only the input they need.
+
+        <read> takes a tuple of slices of the input volume and returns that block (e.g. through
+        nibabel's array proxy), so only one slab of the volume is ever held in memory.
+        The block includes a halo of <order> voxels: the result equals apply(...)[start:stop] for
+        order <= 1, spline prefiltering being only approximated on the block for higher orders.
+        """
+        src = self.slab_source(start, stop, halo=max(order, 1))
+        shape = (stop-start,) + self.shape[1:]
+        if any(s.start == s.stop for s in src):
+            return np.full(shape, cval, dtype=output if output is not None else np.float64)
+        block = read(src)
+        to_block = np.eye(len(self.shape)+1)
+        to_block[:-1, -1] = [-s.start for s in src]
+        from_slab = np.eye(len(self.shape)+1)
+        from_slab[0, -1] = start
+        return scipy.ndimage.affine_transform(block, to_block @ self.matrix @ from_slab, output_shape=shape, output=output,
+                                              order=order, mode='constant', cval=cval, prefilter=True)
+
+def deform_to_US(data, a, b, c, spacing=None):
+    """Rotate <data> by <a>, <b> and <c> degrees in the (0,1), (0,2) and (1,2) planes.
+
+    The three rotations (preceded by affine_scaling(data, spacing) when <spacing> is given) are
+    composed with <TransformChain> and resampled once, instead of three chained rotate_image calls.
+    """
+    chain = TransformChain(data.shape)
+    if spacing is not None:
+        chain.scale(spacing)
     # Must be build interatively, rotation breaks axis order
-    data = rotate_image(data, a, axes=(0,1))
-    data = rotate_image(data, b, axes=(0,2)) 
-    data = rotate_image(data, c, axes=(1,2))
-    return data
+    chain.rotate(a, axes=(0,1)).rotate(b, axes=(0,2)).rotate(c, axes=(1,2))
+    return chain.apply(data)
 
 def us_mask(data, sx, ex, sy, ey, sz, ez):
     return data[int(sx):int(ex), int(sy):int(ey), int(sz):int(ez)]
 
+def mask_bounds(shape, fractions=US_MASK):
+    """Return the integer (start, end) pairs used by <us_mask> for a volume of <shape>."""
+    return [(int(fractions[2*i]*shape[i]), int(fractions[2*i+1]*shape[i])) for i in range(3)]
+
+def mitk_source_slices(shape, bounds):
+    """Return the slices of a raw volume of <shape> that <copy_mitk_coodinates> maps onto <bounds>.
+
+    copy_mitk_coodinates only permutes and flips axes, so a box in MITK coordinates is a box in the
+    raw volume: its two opposite corners are traced back through the rot90/flip chain on
+    broadcast index grids (views, no volume-sized allocation).
+    """
+    first = tuple(start for start, end in bounds)
+    last  = tuple(end-1 for start, end in bounds)
+    slices = []
+    for axis, n in enumerate(shape):
+        grid = np.arange(n).reshape([-1 if a == axis else 1 for a in range(3)])
+        grid = copy_mitk_coodinates(np.broadcast_to(grid, shape))
+        lo, hi = sorted((int(grid[first]), int(grid[last])))
+        slices.append(slice(lo, hi+1))
+    return tuple(slices)
+
+def masked_block_reader(in_path, fractions=US_MASK, lazy=True, dtype=np.float64):
+    """Return the shape of the raw block <load_masked_block> loads and a function reading parts of it.
+
+    The function takes a tuple of slices of that block. With <lazy>, each call reads only those
+    voxels from disk through nibabel's array proxy, with the file kept open so that successive
+    slabs along the last (slowest on disk) axis do not decompress the file from its start again.
+    The planes a slab shares with the previous one (its halo) are taken from the previous block
+    instead of being read again, as seeking back in a gzip stream restarts its decompression.
+    """
+    ref = nib.load(in_path, keep_file_open=True) if lazy else nib.load(in_path)
+    shape = ref.shape[:3]
+    bounds = mask_bounds(copy_mitk_coodinates(np.broadcast_to(0, shape)).shape, fractions)
+    src = mitk_source_slices(shape, bounds)
+    convert = as_hu if dtype == np.int16 else lambda data: data.astype(dtype, copy=False)
+    if lazy:
+        previous = {}
+        def fetch(slices):
+            slices = tuple(slice(s.start+r.start, s.start+r.stop) for s, r in zip(src, slices))
+            return convert(np.asarray(ref.dataobj[slices]))
+        def read(slices):
+            lo, hi = slices[-1].start, slices[-1].stop
+            parts, start = [], lo
+            if previous.get('slices') == slices[:-1] and previous['lo'] <= lo < previous['hi']:
+                start = min(hi, previous['hi'])
+                parts.append(previous['block'][..., lo-previous['lo']:start-previous['lo']])
+            if start < hi:
+                parts.append(fetch(slices[:-1] + (slice(start, hi),)))
+            block = np.concatenate(parts, axis=-1) if len(parts) > 1 else parts[0]
+            previous.update(slices=slices[:-1], lo=lo, hi=hi, block=block)
+            return block
+    else:
+        block = convert(np.asarray(ref.dataobj)[src] if dtype == np.int16 else ref.get_fdata(dtype=dtype)[src])
+        def read(slices):
+            return block[slices]
+    return tuple(s.stop - s.start for s in src), read
+
+def load_masked_block(in_path, fractions=US_MASK, lazy=True, dtype=np.float64):
+    """Load the raw (not yet MITK-oriented) block of a volume that <us_mask> keeps.
+
+    With <lazy>, only that block is read from disk through nibabel's array proxy; otherwise the
+    whole volume is loaded and cropped in memory.
+    <dtype> is either a float type or np.int16, in which case values are kept as raw HU (see <as_hu>).
+    """
+    shape, read = masked_block_reader(in_path, fractions, lazy, dtype)
+    return read(tuple(slice(0, n) for n in shape))
+
+def load_masked_volume(in_path, fractions=US_MASK, lazy=True, dtype=np.float64):
+    """Load the <us_mask> region of a volume, in MITK coordinates (see <load_masked_block>)."""
+    return copy_mitk_coodinates(load_masked_block(in_path, fractions, lazy, dtype))
+
 def clear_folder(path):
     folder = path
     for filename in os.listdir(folder):
@@ -120,52 +468,388 @@ def timelog(verbose, message):
     if verbose:
         print(timestamp(), message)
 
-def apply_on_whole_folder(in_path, out_path, verbose=0):
-    files = os.listdir(in_path)
-    i = 0
-    for f in files:
-        print(i, f)
-        i = i+1
-        if os.path.splitext(f)[1] == '.gz':
-            process_data(os.path.join(in_path,f), out_path)
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS, when the OS allows it (Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
-def process_data(in_path, out_path, verbose=0):
-    
-    ref = nib.load(in_path)
-    data = ref.get_fdata()  
-    timelog(verbose, data.shape)
+def peak_rss_mb():
+    """Return the peak RSS of this process in MB since the last <reset_peak_rss>.
 
-    vmin  = -150
-    vmax  =  150
-    
-    timelog(verbose, "rotating...")
-    data = copy_mitk_coodinates(data)
+    Falls back to the peak over the whole life of the process where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+class Profiler():
+    """Record the wall time, CPU time and peak RSS of the stages of <process_data> for one volume.
+
+    Stages are timed with the <stage> context manager. A stage run several times (e.g. once per slab)
+    is reported once, with its number of calls, its total times and its highest peak RSS.
+    CPU time is the time of the whole process (all threads, including the slice writer's).
+    """
+
+    FIELDS = ['file', 'stage', 'calls', 'wall', 'cpu', 'peak_rss_mb']
+
+    def __init__(self, in_file=None, verbose=0):
+        self.in_file = in_file
+        self.verbose = verbose
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        timelog(self.verbose, name + "...")
+        reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'file': self.in_file, 'stage': name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+            record['calls'] += 1
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += time.process_time() - cpu
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_mb())
+
+    def log(self, message):
+        timelog(self.verbose, message)
+
+    @property
+    def records(self):
+        return list(self.stages.values())
+
+def profile_summary(records):
+    """Aggregate the <Profiler> records of several volumes into one record per stage.
+
+    In these, file is 'ALL', calls is the number of volumes, wall and cpu are totals and
+    peak_rss_mb is the highest peak.
+    """
+    summary = {}
+    for r in records:
+        total = summary.setdefault(r['stage'], {'file': 'ALL', 'stage': r['stage'], 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0})
+        total['calls'] += 1
+        total['wall'] += r['wall']
+        total['cpu'] += r['cpu']
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], r['peak_rss_mb'])
+    return list(summary.values())
+
+def write_profile(records, path):
+    """Write <Profiler> records and their <profile_summary> as JSON, or as CSV if <path> ends with .csv."""
+    summary = profile_summary(records)
+    if os.path.splitext(path)[1] == '.csv':
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, Profiler.FIELDS)
+            writer.writeheader()
+            writer.writerows(records + summary)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'stages': records, 'summary': summary}, f, indent=1)
+
+def print_profile(records):
+    print('%-10s %7s %10s %10s %10s %12s' % ('stage', 'volumes', 'wall (s)', 'mean (s)', 'cpu (s)', 'peak (MB)'))
+    for r in profile_summary(records):
+        print('%-10s %7d %10.2f %10.2f %10.2f %12.0f' % (r['stage'], r['calls'], r['wall'], r['wall'] / r['calls'], r['cpu'], r['peak_rss_mb']))
+
+class Manifest():
+    """Remember which volumes of a batch are already processed, and with which parameters.
+
+    Entries map a volume file name to a key hashing its stamp (size and mtime, or a hash of its
+    content with <content_hash>) and the processing parameters. The manifest is rewritten atomically
+    after every volume, so an interrupted batch resumes where it stopped, and a volume is redone as
+    soon as the file or any parameter changes.
+    """
+
+    def __init__(self, path, content_hash=False):
+        self.path = path
+        self.content_hash = content_hash
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def key(self, in_file, params):
+        if self.content_hash:
+            digest = hashlib.sha1()
+            with open(in_file, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    digest.update(block)
+            stamp = digest.hexdigest()
+        else:
+            st = os.stat(in_file)
+            stamp = [st.st_size, st.st_mtime_ns]
+        return hashlib.sha1(json.dumps([stamp, params], sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_done(self, in_file, key):
+        return self.entries.get(os.path.basename(in_file)) == key
+
+    def record(self, in_file, key):
+        self.entries[os.path.basename(in_file)] = key
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def processing_params(writer_options=None, **kwargs):
+    """Return every parameter of <process_data> (defaults included) that changes its output."""
+    params = {name: p.default for name, p in inspect.signature(process_data).parameters.items()
+              if p.default is not inspect.Parameter.empty}
+    params.update(kwargs)
+    for name in ['verbose', 'writer', 'lazy', 'slab', 'profiler']:
+        params.pop(name, None)
+    # threads, queue and shard sizes only change how slices are written, not what is written
+    params['writer_options'] = {k: v for k, v in (writer_options or {}).items() if k not in ['threads', 'max_pending', 'shard_bytes']}
+    return params
+
+def volume_record(in_file, start, futures=(), error=None, profiler=None):
+    """Wait for the slices of one volume and return its result record.
+
+    The record is a dict with keys file, status ('ok', 'error' or 'skipped'), seconds, error and
+    stages (the records of <profiler>, whose 'write' stage is the wait for the slices).
+    """
+    profiler = profiler or Profiler(in_file)
+    with profiler.stage('write'):
+        for future in futures:
+            if future.exception() is not None and error is None:
+                error = repr(future.exception())
+    return {'file': in_file, 'status': 'ok' if error is None else 'error', 'seconds': time.time() - start, 'error': error,
+            'stages': profiler.records}
+
+def process_volume(in_file, out_path, verbose=0, writer_options=None, **kwargs):
+    """Run <process_data> on one volume and return a result record instead of raising.
+
+    Slices are written by the writer <get_writer> builds from <writer_options>, and extra keyword arguments
+    are forwarded to <process_data>.
+    """
+    start = time.time()
+    profiler = Profiler(in_file, verbose)
+    writer = get_writer(out_path, **(writer_options or {}))
+    try:
+        futures = process_data(in_file, out_path, verbose, writer=writer, profiler=profiler, **kwargs)
+    except Exception as e:
+        return volume_record(in_file, start, error=repr(e), profiler=profiler)
+    finally:
+        writer.close()
+    return volume_record(in_file, start, futures, profiler=profiler)
+
+def print_summary(results):
+    for r in results:
+        line = '%-6s %8.1fs  %s' % (r['status'], r['seconds'], os.path.split(r['file'])[1])
+        if r['error'] is not None:
+            line += '  ' + r['error']
+        print(line)
+    failed = sum(r['status'] == 'error' for r in results)
+    skipped = sum(r['status'] == 'skipped' for r in results)
+    print(timestamp(), '%d volumes processed, %d failed, %d skipped' % (len(results) - skipped, failed, skipped))
+
+def apply_on_whole_folder(in_path, out_path, verbose=0, workers=1, max_in_flight=None, writer_options=None,
+                          resume=True, content_hash=False, profile=None, **kwargs):
+    """Process every .nii.gz volume of <in_path>, optionally with a pool of <workers> processes.
+
+    Slices are written by the writer <get_writer> builds from <writer_options>, and extra keyword arguments
+    are forwarded to <process_data>. When processing serially, a volume's slices are still being
+    encoded while the next volume is resampled.
+    At most <max_in_flight> volumes (default: 2 x workers) are submitted to the pool at once,
+    which caps memory to a few volumes per worker. A failing volume is reported in the
+    returned summary and does not stop the batch. When a worker dies, the volumes in flight are
+    run again one at a time, and only those that kill their worker again are reported as failed.
+    With <resume>, volumes recorded in <out_path>/manifest.json with the same file stamp and
+    parameters are skipped (see <Manifest>).
+    With <profile>, the per-stage timings of every volume and their summary are written to that
+    JSON or CSV file (see <Profiler>).
+    """
+    files = sorted(f for f in os.listdir(in_path) if os.path.splitext(f)[1] == '.gz')
+    files = [os.path.join(in_path, f) for f in files]
+    order = {f: i for i, f in enumerate(files)}
+    results = []
+
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    manifest = Manifest(os.path.join(out_path, 'manifest.json'), content_hash)
+    params = processing_params(writer_options, **kwargs)
+    keys = {f: manifest.key(f, params) for f in files}
+    if resume:
+        results = [{'file': f, 'status': 'skipped', 'seconds': 0.0, 'error': None} for f in files if manifest.is_done(f, keys[f])]
+        files = [f for f in files if not manifest.is_done(f, keys[f])]
+
+    def collect(record):
+        results.append(record)
+        if record['status'] == 'ok':
+            manifest.record(record['file'], keys[record['file']])
+        timelog(verbose, '%d/%d %s %s' % (len(results), len(order), record['status'], record['file']))
+
+    if workers <= 1:
+        writer = get_writer(out_path, **(writer_options or {}))
+        previous = None
+        for f in files:
+            start, futures, error, profiler = time.time(), [], None, Profiler(f, verbose)
+            try:
+                futures = process_data(f, out_path, verbose, writer=writer, profiler=profiler, **kwargs)
+            except Exception as e:
+                error = repr(e)
+            if previous is not None:  # the previous volume's slices were encoded meanwhile
+                collect(volume_record(*previous))
+            previous = (f, start, futures, error, profiler)
+        if previous is not None:
+            collect(volume_record(*previous))
+        writer.close()
+    else:
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+        pool = ProcessPoolExecutor(max_workers=workers)
+        pending = {}
+        queue = list(files)
+        crashed = set()  # volumes already lost once with a dead worker
+
+        def restart(pool, error):
+            # a worker died (e.g. killed by the OOM killer): the pool is unusable and every volume in
+            # flight is lost with it. They go back to the queue once, to be run alone, so that only the
+            # volume that kills its worker again is reported as failed; the batch goes on in a new pool
+            lost = []
+            for future, f in pending.items():
+                if future.done() and not future.cancelled() and future.exception() is None:  # finished before the crash
+                    collect(future.result())
+                elif f in crashed:
+                    collect({'file': f, 'status': 'error', 'seconds': 0.0, 'error': repr(error)})
+                else:
+                    crashed.add(f)
+                    lost.append(f)
+            queue[:0] = sorted(lost, key=order.get)
+            pending.clear()
+            pool.shutdown(wait=False)
+            return ProcessPoolExecutor(max_workers=workers)
+
+        try:
+            while queue or pending:
+                try:
+                    while queue and len(pending) < max_in_flight and not (pending and queue[0] in crashed):
+                        pending[pool.submit(process_volume, queue[0], out_path, verbose, writer_options, **kwargs)] = queue[0]
+                        if queue.pop(0) in crashed:
+                            break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            record = future.result()
+                        except BrokenProcessPool:
+                            raise
+                        except Exception as e:
+                            record = {'file': pending[future], 'status': 'error', 'seconds': 0.0, 'error': repr(e)}
+                        pending.pop(future)
+                        collect(record)
+                except BrokenProcessPool as e:
+                    pool = restart(pool, e)
+        finally:
+            pool.shutdown()
+
+    results.sort(key=lambda r: order[r['file']])
+    print_summary(results)
+    records = [stage for r in results for stage in r.get('stages', [])]
+    if verbose and records:
+        print_profile(records)
+    if profile is not None:
+        write_profile(records, profile)
+    return results
+
+def process_data(in_path, out_path, verbose=0, lazy=True, dtype=np.float32, writer=None,
+                 vmin=-150, vmax=150, mask=US_MASK, angle=45, padding=((0,0), (1,2), (1,2)), slab=None,
+                 profiler=None):
+    """Extract the US-like slices of one volume and return the Futures of the written slices.
+
+    Slices are queued on <writer> (see <extract_all_slices>).
+    <dtype> is the working type of the resampling. With np.float64 the whole pipeline runs in float64
+    as it originally did; otherwise raw HU are kept as int16, windowed into uint8 through a lookup
+    table and only the rotation runs in <dtype>.
+    With <slab>, the volume is streamed by slabs of <slab> output slices (see <TransformChain.apply_slab>):
+    each slab reads, normalises and rotates only the voxels it needs and its slices are queued as soon
+    as it is done, so memory is bounded by the slab size instead of the volume size.
+    The mask (loading), normalise, rotate, pad and sample stages are timed on <profiler> (see <Profiler>).
+    """
+
+    compact = dtype != np.float64
+    profiler = profiler or Profiler(in_path, verbose)
     
-    timelog(verbose,  "masking...")
-    data = us_mask(data, 0.35*data.shape[0], 0.5*data.shape[0], 0.3*data.shape[1], 0.65*data.shape[1], 0.35*data.shape[2], 0.7*data.shape[2])
+    shape, read = masked_block_reader(in_path, mask, lazy=lazy, dtype=np.int16 if compact else np.float64)
+    profiler.log(shape)
     
-    timelog(verbose,  "normalising...")  
-    data = normalise_image(data, vmin, vmax)
+    def normalise(data):
+        return window_image(data, vmin, vmax) if compact else normalise_image(data, vmin, vmax)
     
-    timelog(verbose,  "rotating...")
-    data = rotate_image(data, 45, axes=(1,2))
+    # MITK orientation and 45 degree rotation resampled in one pass
+    chain = TransformChain(shape).mitk().rotate(angle, axes=(1,2))
     
-    timelog(verbose, "padding...")
-    data = np.pad(data, ((0,0), (1,2), (1,2)))
+    if slab is None:
+        with profiler.stage('mask'):
+            data = read(tuple(slice(0, n) for n in shape))
+        with profiler.stage('normalise'):
+            data = normalise(data)
+        with profiler.stage('rotate'):
+            data = chain.apply(data, output=dtype)
+            if compact:
+                data = data.astype(np.uint8)
+        with profiler.stage('pad'):
+            data = np.pad(data, padding)
+        with profiler.stage('sample'):
+            return extract_all_slices(data, 0, in_path, out_path, writer=writer)
     
-    timelog(verbose, "sampling...")
-    extract_all_slices(data, 0, in_path, out_path)
+    n = chain.shape[0]
+    starts = range(0, n, slab)
+    # read the slabs in file order, the slices are named by their index anyway
+    starts = sorted(starts, key=lambda start: chain.slab_source(start, min(start+slab, n))[-1].start)
+    futures = []
+    for start in starts:
+        stop = min(start+slab, n)
+        profiler.log("slab %d:%d" % (start, stop))
+        with profiler.stage('mask'):
+            block = read(chain.slab_source(start, stop))  # the block apply_slab samples (order 1)
+        with profiler.stage('normalise'):
+            block = normalise(block)
+        with profiler.stage('rotate'):
+            data = chain.apply_slab(lambda src: block, start, stop, output=dtype)
+            if compact:
+                data = data.astype(np.uint8)
+        with profiler.stage('pad'):
+            # the padding along the slab axis only belongs to the first and last slabs
+            before, after = padding[0]
+            data = np.pad(data, ((before if start == 0 else 0, after if stop == n else 0),) + tuple(padding[1:]))
+        with profiler.stage('sample'):
+            futures += extract_all_slices(data, 0, in_path, out_path, writer=writer, offset=start + (before if start > 0 else 0))
+    return futures
 
-if __name__ == '__main__':    
-    # Parameters
-    verbose = 0
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract US-like slices from a folder of CT volumes.')
+    parser.add_argument('in_path', help='folder containing the .nii.gz volumes')
+    parser.add_argument('out_path', help='folder where the slices are written')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (1: process volumes serially)')
+    parser.add_argument('--max_in_flight', type=int, default=None, help='maximum number of volumes queued in the pool (default: 2 x workers)')
+    parser.add_argument('--no_lazy', action='store_true', help='load whole volumes with get_fdata instead of reading only the masked block')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float64'], help='working type of the resampling (float64: original full float64 pipeline)')
+    parser.add_argument('--format', type=str, default='jpeg', choices=list(IMAGE_FORMATS) + ['shard'], help='image format of the slices, or shard to append them to raw shard files with a csv index')
+    parser.add_argument('--shard_bytes', type=int, default=2**30, help='maximum size of a shard file (shard format only)')
+    parser.add_argument('--quality', type=int, default=None, help='JPEG/WebP quality or PNG compression level (default: PIL default)')
+    parser.add_argument('--writer_threads', type=int, default=4, help='number of threads encoding slices per process (0: encode on the main thread)')
+    parser.add_argument('--max_pending', type=int, default=64, help='maximum number of slices queued for encoding per process')
+    parser.add_argument('--no_resume', action='store_true', help='reprocess every volume, even those already recorded in the output manifest')
+    parser.add_argument('--content_hash', action='store_true', help='identify input volumes by a hash of their content instead of their size and mtime')
+    parser.add_argument('--slab', type=int, default=None, help='stream each volume by slabs of this many output slices to bound memory (default: whole volume at once)')
+    parser.add_argument('--profile', type=str, default=None, help='write per-stage wall time, CPU time and peak RSS of every volume to this JSON or CSV file')
+    parser.add_argument('--verbose', action='store_true', help='print progress information')
+    args = parser.parse_args()
     # in_path = "/home/hadrien/Bureau/PhD Year 1/Research/LUNG_CT/LIDC-IDRI-000"+str(lung_id)+".nii.gz"
     # out_path = "/home/hadrien/Bureau/PhD Year 1/Research/LUNG_CT/slices"
 
-    in_path = sys.argv[1]
-    out_path = sys.argv[2]
-    
-    apply_on_whole_folder(in_path, out_path)
+    apply_on_whole_folder(args.in_path, args.out_path, verbose=args.verbose, workers=args.workers, max_in_flight=args.max_in_flight,
+                          lazy=not args.no_lazy, dtype=np.dtype(args.dtype).type, slab=args.slab,
+                          writer_options={'fmt': args.format, 'quality': args.quality, 'threads': args.writer_threads,
+                                          'max_pending': args.max_pending, 'shard_bytes': args.shard_bytes},
+                          resume=not args.no_resume, content_hash=args.content_hash, profile=args.profile)
 
 
     # ref = nib.load(in_path)
@@ -0,0 +1,248 @@
+"""Offline benchmark of the CT preprocessing pipeline and of the demo Engine.
+
+Synthetic CT volumes (int16 HU NIfTI files with air, body, lungs, heart and spine) are generated once
+in --data_dir and reused, so numbers are reproducible from one run to the next. Each benchmark is
+run --repeat times after --warmup untimed runs and reports latency percentiles and throughput.
+
+Example:
+    Record a baseline, then compare a later run against it:
+        python benchmark.py --save_baseline benchmark_baseline.json
+        python benchmark.py --baseline benchmark_baseline.json
+
+    Quick run on a smaller volume:
+        python benchmark.py --sizes 256x256x120 --repeat 3
+
+    Operator micro-benchmarks of the networks only:
+        python benchmark.py --sizes --ops --no_gan
+
+gen_us needs the CUT checkpoint in ./checkpoints; it is skipped (and reported as such) otherwise.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nib
+
+import CTHandler
+from engine import Engine, VOLUME_CACHE
+
+
+def parse_size(text):
+    return tuple(int(n) for n in text.lower().split('x'))
+
+def make_volume(path, shape, seed=0, spacing=(0.7, 0.7, 1.25)):
+    """Write a synthetic int16 CT volume of <shape> (x, y, z) to <path>.
+
+    Each axial slice is an elliptic body (soft tissue) in air, with two lungs, a heart and a spine,
+    plus gaussian noise. The content only has to look like a CT to the pipeline: same types, same
+    value range and about the same proportion of air.
+    """
+    rng = np.random.RandomState(seed)
+    sx, sy, sz = shape
+    x, y = np.meshgrid(np.linspace(-1, 1, sx), np.linspace(-1, 1, sy), indexing='ij')
+
+    def ellipse(cx, cy, rx, ry):
+        return ((x-cx)/rx)**2 + ((y-cy)/ry)**2 <= 1
+
+    axial = np.full((sx, sy), -1000, dtype=np.int16)
+    axial[ellipse(0, 0, 0.9, 0.65)] = 40
+    axial[ellipse(-0.4, 0, 0.3, 0.4)] = -800
+    axial[ellipse(0.4, 0, 0.3, 0.4)] = -800
+    axial[ellipse(0.05, -0.15, 0.2, 0.2)] = 60
+    axial[ellipse(0, 0.45, 0.08, 0.08)] = 700
+
+    data = np.empty(shape, dtype=np.int16)
+    for z in range(sz):
+        noise = rng.normal(0, 20, size=(sx, sy)).astype(np.int16)
+        data[:, :, z] = axial + noise
+    affine = np.diag(list(spacing) + [1.0])
+    nib.save(nib.Nifti1Image(data, affine), path)
+
+def get_volume(data_dir, shape):
+    """Return the path of the synthetic volume of <shape>, generating it if needed."""
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    # LIDC-IDRI-like name, CTHandler uses its characters 10 to 14 as identifier
+    path = os.path.join(data_dir, 'LIDC-IDRI-%s.nii.gz' % 'x'.join(str(n) for n in shape))
+    if not os.path.exists(path):
+        print(CTHandler.timestamp(), 'generating', path)
+        make_volume(path, shape)
+    return path
+
+def measure(function, repeat=5, warmup=1, setup=None):
+    """Return the wall times of <repeat> calls of <function>, after <warmup> untimed calls.
+
+    <setup>, if given, is called (untimed) before each call.
+    """
+    times = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return times
+
+def statistics(times, items=1):
+    """Latency percentiles (in ms) and throughput (<items> per second) of a list of wall times."""
+    times = np.array(times)
+    return {'runs': len(times), 'items': items,
+            'mean_ms': 1000*times.mean(), 'p50_ms': 1000*np.percentile(times, 50),
+            'p90_ms': 1000*np.percentile(times, 90), 'p99_ms': 1000*np.percentile(times, 99),
+            'min_ms': 1000*times.min(), 'throughput': items/np.median(times)}
+
+def load_gan(gpu=False, backend='eager'):
+    """Build the CUT wrapper the demo uses, or return the reason it cannot be built."""
+    argv = sys.argv
+    sys.argv = argv[:1]  # TestOptions parses the command line
+    try:
+        from test import CUTTestWrapper
+        return CUTTestWrapper(data_path='tmp_ct_to_us', gpu=gpu, backend=backend), None
+    except Exception as e:
+        return None, repr(e)
+    finally:
+        sys.argv = argv
+
+def benchmark_volume(path, opt, gan=None):
+    """Run every benchmark on the volume at <path> and return {name: statistics}."""
+    results = {}
+    out_dir = tempfile.mkdtemp(prefix='benchmark_')
+
+    def run(name, function, items=1, setup=None):
+        results[name] = statistics(measure(function, opt.repeat, opt.warmup, setup), items)
+        r = results[name]
+        print('%-28s %9.1f %9.1f %9.1f %9.1f %10.1f' % (name, r['mean_ms'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['throughput']))
+
+    print('%-28s %9s %9s %9s %9s %10s' % ('benchmark', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'items/s'))
+    try:
+        # CTHandler
+        n_slices = len(CTHandler.process_data(path, out_dir))
+        def process():
+            writer = CTHandler.get_writer(out_dir)
+            CTHandler.process_data(path, out_dir, writer=writer)
+            writer.close()
+        run('process_data', process, n_slices)
+
+        sampled = np.zeros((n_slices, 300, 300), dtype=np.uint8)
+        def extract():
+            writer = CTHandler.get_writer(out_dir)
+            CTHandler.extract_all_slices(sampled, 0, path, out_dir, writer=writer)
+            writer.close()
+        run('extract_all_slices', extract, n_slices)
+
+        # Engine, with the default parameters of the demo
+        eng = Engine()
+        eng.input_folder, name = os.path.split(path)
+        run('Engine.load_sel_file', lambda: eng.load_sel_file(name), setup=VOLUME_CACHE.clear)
+        run('Engine.load_sel_file cached', lambda: eng.load_sel_file(name))
+        index = eng.data.shape[0]//2
+        imin, imax = eng.data_min, eng.data_max
+        run('get_tilted_img_at_index', lambda: eng.get_tilted_img_at_index(opt.tilt, opt.tilt, index, imin, imax))
+        run('rotate_ax_image', lambda: eng.rotate_ax_image(44),
+            setup=lambda: eng.get_tilted_img_at_index(opt.tilt, opt.tilt, index, imin, imax))
+        run('get_image_sa_at_index', lambda: eng.get_image_sa_at_index(index, imin, imax, y=opt.tilt, z=opt.tilt))
+        if gan is not None:
+            eng.attach(gan)
+            eng.draw_ROI(160, 420, 60, 320)
+            run('gen_us' if opt.backend == 'eager' else 'gen_us %s' % opt.backend, eng.gen_us)
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+def benchmark_ops(opt):
+    """Time the network operators that have several implementations and return {name: statistics}.
+
+    fused_leaky_relu runs on an activation of a StyleGAN2 layer (batch 4, 256 channels, 64x64),
+    forward only and forward + backward.
+    """
+    import torch
+    from models import stylegan_networks
+
+    results = {}
+
+    def run(name, function):
+        results[name] = statistics(measure(function, opt.repeat, opt.warmup))
+        r = results[name]
+        print('%-40s %9.1f %9.1f %9.1f %9.1f' % (name, r['mean_ms'], r['p50_ms'], r['p90_ms'], r['p99_ms']))
+
+    print('%-40s %9s %9s %9s %9s' % ('operator', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms'))
+    torch.manual_seed(0)
+    x = torch.randn(4, 256, 64, 64, requires_grad=True)
+    bias = torch.zeros(1, 256, 1, 1, requires_grad=True)
+    grad = torch.randn(4, 256, 64, 64)
+    for name, function in [('native', stylegan_networks.fused_leaky_relu_native), ('fused', stylegan_networks.fused_leaky_relu)]:
+        def forward():
+            with torch.no_grad():
+                function(x, bias)
+        def backward():
+            function(x, bias).backward(grad)
+        run('fused_leaky_relu %s' % name, forward)
+        run('fused_leaky_relu %s fwd+bwd' % name, backward)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print the p50 of <results> relative to <baseline> and return the names of the regressions."""
+    regressions = []
+    print('%-40s %10s %10s %8s' % ('benchmark', 'base p50', 'p50', 'ratio'))
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        ratio = r['p50_ms'] / baseline[name]['p50_ms']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-40s %10.1f %10.1f %7.2fx%s' % (name, baseline[name]['p50_ms'], r['p50_ms'], ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark CTHandler and Engine on synthetic CT volumes.')
+    parser.add_argument('--sizes', type=str, nargs='*', default=['512x512x300', '512x512x800'], help='volume sizes, as XxYxZ (none: skip the volume benchmarks)')
+    parser.add_argument('--data_dir', type=str, default='benchmark_data', help='folder where the synthetic volumes are generated and cached')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs per benchmark')
+    parser.add_argument('--warmup', type=int, default=1, help='number of untimed runs before the timed ones')
+    parser.add_argument('--tilt', type=float, default=10.0, help='saggital and coronal tilts used for the Engine benchmarks')
+    parser.add_argument('--ops', action='store_true', help='also run the operator micro-benchmarks of the networks (see benchmark_ops)')
+    parser.add_argument('--no_gan', action='store_true', help='do not load the CUT model, skip gen_us')
+    parser.add_argument('--gpu', action='store_true', help='run gen_us on the GPU')
+    parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnx', 'int8'], help='generator backend used by gen_us (see models/export.py)')
+    parser.add_argument('--save_baseline', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare the results against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative p50 slowdown reported as a regression')
+    opt = parser.parse_args()
+
+    gan = None
+    if not opt.no_gan:
+        gan, reason = load_gan(opt.gpu, opt.backend)
+        if gan is None:
+            print(CTHandler.timestamp(), 'gen_us skipped, the CUT model could not be loaded:', reason)
+
+    results = {}
+    for size in opt.sizes:
+        path = get_volume(opt.data_dir, parse_size(size))
+        print(CTHandler.timestamp(), size)
+        for name, r in benchmark_volume(path, opt, gan).items():
+            results['%s %s' % (size, name)] = r
+    if opt.ops:
+        print(CTHandler.timestamp(), 'operators')
+        for name, r in benchmark_ops(opt).items():
+            results['ops %s' % name] = r
+
+    meta = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'repeat': opt.repeat, 'warmup': opt.warmup}
+    if opt.save_baseline is not None:
+        with open(opt.save_baseline, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if opt.baseline is not None:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, opt.tolerance)
+        if regressions:
+            sys.exit(1)
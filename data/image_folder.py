@@ -2,13 +2,21 @@
 
 We modify the official PyTorch image folder (https://github.com/pytorch/vision/blob/master/torchvision/datasets/folder.py)
 so that this class can load images from both current directory and its subdirectories.
+
+A directory can also be a shard folder written by CTHandler.ShardWriter (raw uint8 slices appended to
+shard-*.bin files, indexed by index-*.csv files). Its slices are listed by make_dataset as virtual
+paths <dir>/<identifier>-<index> and opened with load_image.
 """
 
 import torch.utils.data as data
 
 from PIL import Image
+import csv
+import glob
+import numpy as np
 import os
 import os.path
+from functools import lru_cache
 
 IMG_EXTENSIONS = [
     '.jpg', '.JPG', '.jpeg', '.JPEG',
@@ -21,10 +29,66 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
+@lru_cache(maxsize=None)
+def read_shard_index(dir):
+    """Return {'<identifier>-<index>': (shard path, offset, height, width)} for a shard folder, {} otherwise.
+
+    A volume written several times keeps the slices of its latest write only (highest stamp column,
+    see CTHandler.ShardWriter), so slices of an older run are neither used nor listed. Rows that are
+    incomplete or point past the end of their shard, as left by a writer killed in the middle of a
+    volume, are skipped.
+    """
+    volumes = {}  # identifier -> (stamp, {key: slice})
+    shard_sizes = {}
+    for index_path in sorted(glob.glob(os.path.join(dir, 'index-*.csv'))):
+        with open(index_path, newline='') as f:
+            for row in csv.reader(f):
+                if len(row) != 7:
+                    continue
+                identifier, shard = row[0], os.path.join(dir, row[2])
+                try:
+                    i, offset, height, width, stamp = [int(row[n]) for n in (1, 3, 4, 5, 6)]
+                except ValueError:
+                    continue
+                if shard not in shard_sizes:
+                    shard_sizes[shard] = os.path.getsize(shard) if os.path.isfile(shard) else 0
+                if offset < 0 or height <= 0 or width <= 0 or offset + height * width > shard_sizes[shard]:
+                    continue
+                if identifier not in volumes or stamp > volumes[identifier][0]:
+                    volumes[identifier] = (stamp, {})
+                elif stamp < volumes[identifier][0]:
+                    continue
+                volumes[identifier][1]['%s-%03d' % (identifier, i)] = (shard, offset, height, width)
+    index = {}
+    for _, slices in volumes.values():
+        index.update(slices)
+    return index
+
+
+@lru_cache(maxsize=64)
+def open_shard(path):
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def load_image(path):
+    """Open an image file, or a slice of a shard folder given as a path returned by make_dataset"""
+    root, key = os.path.split(path)
+    index = read_shard_index(root)
+    if key in index:
+        shard, offset, height, width = index[key]
+        return Image.fromarray(open_shard(shard)[offset:offset + height * width].reshape(height, width))
+    return Image.open(path)
+
+
 def make_dataset(dir, max_dataset_size=float("inf")):
     images = []
     assert os.path.isdir(dir) or os.path.islink(dir), '%s is not a valid directory' % dir
 
+    shard_index = read_shard_index(dir)
+    if shard_index:
+        images = [os.path.join(dir, key) for key in sorted(shard_index)]
+        return images[:min(max_dataset_size, len(images))]
+
     for root, _, fnames in sorted(os.walk(dir, followlinks=True)):
         for fname in fnames:
             if is_image_file(fname):
@@ -34,7 +98,7 @@ def make_dataset(dir, max_dataset_size=float("inf")):
 
 
 def default_loader(path):
-    return Image.open(path).convert('RGB')
+    return load_image(path).convert('RGB')
 
 
 class ImageFolder(data.Dataset):
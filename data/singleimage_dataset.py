@@ -1,7 +1,7 @@
 import numpy as np
 import os.path
 from data.base_dataset import BaseDataset, get_transform
-from data.image_folder import make_dataset
+from data.image_folder import make_dataset, load_image
 from PIL import Image
 import random
 import util.util as util
@@ -37,8 +37,8 @@ class SingleImageDataset(BaseDataset):
 
         assert len(self.A_paths) == 1 and len(self.B_paths) == 1,\
             "SingleImageDataset class should be used with one image in each domain"
-        A_img = Image.open(self.A_paths[0]).convert('RGB')
-        B_img = Image.open(self.B_paths[0]).convert('RGB')
+        A_img = load_image(self.A_paths[0]).convert('RGB')
+        B_img = load_image(self.B_paths[0]).convert('RGB')
         print("Image sizes %s and %s" % (str(A_img.size), str(B_img.size)))
 
         self.A_img = A_img
@@ -1,7 +1,6 @@
 import os.path
 from data.base_dataset import BaseDataset, get_transform
-from data.image_folder import make_dataset
-from PIL import Image
+from data.image_folder import make_dataset, load_image
 import random
 import util.util as util
 
@@ -55,8 +54,8 @@ class UnalignedDataset(BaseDataset):
         else:   # randomize the index for domain B to avoid fixed pairs.
             index_B = random.randint(0, self.B_size - 1)
         B_path = self.B_paths[index_B]
-        A_img = Image.open(A_path).convert('RGB')
-        B_img = Image.open(B_path).convert('RGB')
+        A_img = load_image(A_path).convert('RGB')
+        B_img = load_image(B_path).convert('RGB')
 
         # Apply image transformation
         # For FastCUT mode, if in finetuning phase (learning rate is decaying),
@@ -64,9 +63,11 @@ class UnalignedDataset(BaseDataset):
 #        print('current_epoch', self.current_epoch)
         is_finetuning = self.opt.isTrain and self.current_epoch > self.opt.n_epochs
         modified_opt = util.copyconf(self.opt, load_size=self.opt.crop_size if is_finetuning else self.opt.load_size)
-        transform = get_transform(modified_opt)
-        A = transform(A_img)
-        B = transform(B_img)
+        # 1-channel domains (e.g. grayscale CT, see --grayscale_input) are loaded as grayscale
+        input_nc = self.opt.output_nc if self.opt.direction == 'BtoA' else self.opt.input_nc
+        output_nc = self.opt.input_nc if self.opt.direction == 'BtoA' else self.opt.output_nc
+        A = get_transform(modified_opt, grayscale=(input_nc == 1))(A_img)
+        B = get_transform(modified_opt, grayscale=(output_nc == 1))(B_img)
 
         return {'A': A, 'B': B, 'A_paths': A_path, 'B_paths': B_path}
 
@@ -1,13 +1,15 @@
 from typing import final
 import numpy as np
 import nibabel as nib
-import streamlit as st
+import threading
+from collections import OrderedDict, namedtuple
 from math import tan, pi
 from CTHandler import *
+import util.util as util
 
 
 def clamp(data, imin=0.0, imax=1.0, omin=0.0, omax=1.0):
-    data = data.astype(np.float)
+    data = data.astype(np.float64)
     if imin != None:
         data[data<imin] = imin
     else:
@@ -57,6 +59,52 @@ def minmax(value, vmin, vmax):
     value = max(vmin, value)
     return value
 
+CachedVolume = namedtuple('CachedVolume', ['ref', 'data', 'min', 'max'])
+
+class VolumeCache():
+    """Process-wide LRU cache of the MITK-oriented volumes loaded by <Engine.load_sel_file>.
+
+    Volumes are keyed by absolute path and modification time, so an edited file is reloaded, and
+    the least recently used ones are evicted once their total size exceeds <max_bytes> (the last
+    loaded volume is always kept). The cached arrays are read-only: every Engine shares them.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.volumes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            if key in self.volumes:
+                self.volumes.move_to_end(key)
+                return self.volumes[key]
+        
+        ref = nib.load(path)
+        data = copy_mitk_coodinates(ref.get_fdata())
+        data.flags.writeable = False
+        volume = CachedVolume(ref, data, data.min(), data.max())
+        
+        with self.lock:
+            for old in [k for k in self.volumes if k[0] == path]:  # older versions of the file
+                del self.volumes[old]
+            self.volumes[key] = volume
+            while len(self.volumes) > 1 and self.nbytes() > self.max_bytes:
+                self.volumes.popitem(last=False)
+        return volume
+
+    def nbytes(self):
+        return sum(v.data.nbytes for v in self.volumes.values())
+
+    def clear(self):
+        with self.lock:
+            self.volumes.clear()
+
+# budget in bytes, e.g. CT_VOLUME_CACHE_BYTES=8000000000 for 8 GB
+VOLUME_CACHE = VolumeCache(int(os.environ.get('CT_VOLUME_CACHE_BYTES', 4*2**30)))
+
 class Engine():
     def __init__(self):
         self.input_folder = "DATASET"
@@ -64,6 +112,8 @@ class Engine():
         self.files_list = list()
         self.ref = None
         self.data = None  
+        self.data_min = None
+        self.data_max = None
         self.selected_file_path = None
         self.img = None
         self.samp = None
@@ -91,13 +141,15 @@ class Engine():
     
     def load_sel_file(self, selected_file):
         
-        if self.data != None:
+        if self.data is not None:
             old_max = self.data.shape[0]
         
         self.selected_file_path = selected_file
-        self.ref = nib.load(os.path.join(self.input_folder,self.selected_file_path))
-        self.data = self.ref.get_fdata()
-        self.data = copy_mitk_coodinates(self.data)
+        # read-only volume shared through the process-wide cache, loaded once per file
+        volume = VOLUME_CACHE.get(os.path.join(self.input_folder,self.selected_file_path))
+        self.ref = volume.ref
+        self.data = volume.data
+        self.data_min, self.data_max = volume.min, volume.max
 
         # print(self.data.shape)
                 
@@ -198,26 +250,12 @@ class Engine():
     # @st.cache(suppress_st_warning=True)
     def gen_us(self):
         
-        # save image
         # print(self.samp.shape)
-        path = "tmp_ct_to_us/testA/ct.png"
         zoom = 256/self.samp.shape[0]
-        to_save = (scipy.ndimage.zoom(self.samp, (zoom,zoom), order=1) * 255).astype(np.uint8)
-        # print(to_save.shape)
-        Image.fromarray(to_save).save(path)
-        
-        # print("in gen us")
-        # path = "tmp_ct_to_us/testA/ct.png"
-        # zoom = 256/img.shape[0]
-        # to_save = (scipy.ndimage.zoom(img, (zoom,zoom), order=1) * 255).astype(np.uint8)
-        # print(to_save.shape)
-        # Image.fromarray(to_save).save(path)
-        
-        # call gan
-        self.gan.update_data()
-        self.img_us = self.gan.generate()
-
-        # print(rand)
+        to_translate = (scipy.ndimage.zoom(self.samp, (zoom,zoom), order=1) * 255).astype(np.uint8)
+        
+        # call gan, in memory (no more tmp_ct_to_us/testA/ct.png round-trip)
+        self.img_us = util.tensor2im(self.gan.translate(to_translate))
         
         return self.img_us
         
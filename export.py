@@ -0,0 +1,108 @@
+"""Export the generator of a trained model for inference (see models/export.py).
+
+The export is stored next to the checkpoint, where CUTTestWrapper finds it with --backend.
+
+Example:
+    Export the CT to US generator to TorchScript and check it against the eager model:
+        python export.py --name ct2us_qt --epoch 265 --backend torchscript
+
+    Export it to ONNX, run by onnxruntime (see util/onnx_runtime.py):
+        python export.py --name ct2us_qt --epoch 265 --backend onnx
+
+    Quantize it to int8, calibrated on a folder of CT crops, and compare it with the float model:
+        python export.py --name ct2us_qt --epoch 265 --backend int8 --calibration_dir ./datasets/ct2us/trainA
+"""
+import os
+import sys
+import time
+import numpy as np
+import torch
+from options.test_options import TestOptions
+from models import create_model, networks
+from models.export import export_path, export_torchscript, export_onnx, export_int8, OnnxModule, max_difference, unwrap
+from data.base_dataset import get_transform
+from data.image_folder import make_dataset, load_image
+
+
+class ExportOptions(TestOptions):
+    """Test options, plus the parity check of the export."""
+
+    def initialize(self, parser):
+        parser = TestOptions.initialize(self, parser)
+        parser.add_argument('--opset', type=int, default=13, help='ONNX opset version (11 or later)')
+        parser.add_argument('--parity_tolerance', type=float, default=1e-4, help='maximum absolute difference allowed between the eager and exported generators')
+        parser.add_argument('--calibration_dir', type=str, default=None, help='folder of CT crops used to calibrate the int8 generator')
+        parser.add_argument('--calibration_images', type=int, default=32, help='number of images used for the calibration, the others evaluate the int8 generator')
+        parser.add_argument('--quantize_all', action='store_true', help='also quantize the first and last convolutions of the int8 generator')
+        return parser
+
+
+def load_images(opt, paths):
+    """Load images as normalised input tensors, with the test dataset transform."""
+    transform = get_transform(opt, grayscale=(opt.input_nc == 1))
+    return [transform(load_image(path).convert('RGB')).unsqueeze(0) for path in paths]
+
+
+def accuracy_report(reference, quantized, images):
+    """Compare the uint8 images generated by two generators: mean and max absolute difference, and PSNR."""
+    errors = []
+    with torch.no_grad():
+        for real in images:
+            a = ((unwrap(reference)(real).clamp(-1, 1) + 1) * 127.5).round()
+            b = ((quantized(real).clamp(-1, 1) + 1) * 127.5).round()
+            errors.append((a - b).abs().flatten())
+    errors = torch.cat(errors)
+    mse = (errors ** 2).mean().item()
+    psnr = 10 * np.log10(255 ** 2 / mse) if mse > 0 else float('inf')
+    print('int8 vs float on %d images: mean abs diff %.2f, max abs diff %d (0-255), PSNR %.1f dB'
+          % (len(images), errors.mean().item(), errors.max().item(), psnr))
+
+
+def latency(net, input_nc, size, repeat=5):
+    real = torch.zeros(1, input_nc, size, size)
+    with torch.no_grad():
+        for _ in range(3):  # warm up (TorchScript optimizes the graph on the first calls)
+            net(real)
+        start = time.time()
+        for _ in range(repeat):
+            net(real)
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    opt = ExportOptions().parse()  # get test options
+    opt.num_threads = 0
+    opt.batch_size = 1
+    opt.display_id = -1
+    if opt.backend == 'eager':
+        opt.backend = 'torchscript'
+    model = create_model(opt)      # create a model given opt.model and other options
+    model.setup(opt)               # load the networks
+    if opt.grayscale_input:
+        networks.fold_input_channels(model.netG)
+        opt.input_nc = 1
+
+    path = export_path(opt, opt.backend)
+    if opt.backend == 'int8':
+        assert opt.calibration_dir is not None, 'the int8 generator needs --calibration_dir'
+        paths = sorted(make_dataset(opt.calibration_dir))
+        calibration, evaluation = paths[:opt.calibration_images], paths[opt.calibration_images:]
+        exported = export_int8(model.netG, path, load_images(opt, calibration), opt.input_nc, opt.crop_size, not opt.quantize_all)
+        print('saved %s (%.1f MB), calibrated on %d images' % (path, os.path.getsize(path) / 2**20, len(calibration)))
+        accuracy_report(model.netG, exported, load_images(opt, evaluation or calibration))
+    else:
+        if opt.backend == 'torchscript':
+            exported = export_torchscript(model.netG, path, opt.input_nc, opt.crop_size)
+        else:
+            export_onnx(model.netG, path, opt.input_nc, opt.crop_size, opt.opset)
+            exported = OnnxModule(path)
+        print('saved %s (%.1f MB)' % (path, os.path.getsize(path) / 2**20))
+        # parity on the export size and on another size, as height and width are dynamic
+        differences = [max_difference(model.netG, exported, opt.input_nc, size) for size in [opt.crop_size, opt.crop_size // 2 + 4]]
+        print('max difference with the eager generator: %.2e' % max(differences))
+
+    print('latency: eager %.3fs, %s %.3fs' % (latency(model.netG, opt.input_nc, opt.crop_size), opt.backend,
+                                              latency(exported, opt.input_nc, opt.crop_size)))
+    if opt.backend != 'int8' and max(differences) > opt.parity_tolerance:
+        print('the export differs from the eager generator by more than %g' % opt.parity_tolerance)
+        sys.exit(1)
@@ -1,13 +1,56 @@
 import streamlit as st
 import numpy as np
 import pandas as pd
+import threading
 import time
 
 from engine import Engine
 from test import CUTTestWrapper
 
+class ModelHolder():
+    """Holds the CUT model of this server process, built on first use and shared by every rerun and session.
+
+    A failed build (e.g. the checkpoint is still being copied) is retried by the first get() at least
+    <retry_seconds> after it, and its error is reported by status() meanwhile.
+    """
+    def __init__(self, retry_seconds=30):
+        self.lock = threading.Lock()
+        self.model = None
+        self.error = None
+        self.failed_at = None
+        self.retry_seconds = retry_seconds
+        self.build_seconds = None
+        self.uses = 0
+
+    def get(self):
+        with self.lock:
+            if self.model is None and (self.failed_at is None or time.time() - self.failed_at >= self.retry_seconds):
+                start = time.time()
+                try:
+                    self.model = CUTTestWrapper(data_path='tmp_ct_to_us', gpu=False)
+                    self.error, self.failed_at = None, None
+                except Exception as e:
+                    self.error, self.failed_at = repr(e), time.time()
+                self.build_seconds = time.time() - start
+            if self.model is not None:
+                self.uses += 1
+            return self.model
+
+    def status(self):
+        if self.model is None:
+            retry = max(self.retry_seconds - (time.time() - self.failed_at), 0)
+            return 'Model: failed to load (%s), retrying in %.0fs' % (self.error, retry)
+        if self.uses <= 1:
+            return 'Model: cold start, built in %.1fs' % self.build_seconds
+        return 'Model: warm (built in %.1fs, reused %d times)' % (self.build_seconds, self.uses - 1)
+
+@st.cache(allow_output_mutation=True)
+def get_model_holder():
+    # cached once per server process; sessions starting together wait on the holder's lock instead of each building a model
+    return ModelHolder()
+
 def get_model():
-    return CUTTestWrapper(data_path='tmp_ct_to_us', gpu=False)
+    return get_model_holder().get()
 
 """
 # Cardiac CT Scan to Ultrasound
@@ -50,19 +93,23 @@ vertical_cut   = st.sidebar.slider( 'Select vertical sampling:',   0, 511, (60,3
 # st.sidebar.text('WIP:')
 # value_range = st.sidebar.slider( 'Select a range of values (do not use)', eng.data.min(), eng.data.max(), (np.float(eng.data.min()), np.float(eng.data.max())))
 
-# img_ax = eng.get_image_ax_at_index(ax_index, imin=eng.data.min(), imax=eng.data.max())
-img_ax = eng.get_tilted_img_at_index(tilt1, tilt2, ax_index, imin=eng.data.min(), imax=eng.data.max())
+# img_ax = eng.get_image_ax_at_index(ax_index, imin=eng.data_min, imax=eng.data_max)
+img_ax = eng.get_tilted_img_at_index(tilt1, tilt2, ax_index, imin=eng.data_min, imax=eng.data_max)
 img_ax = eng.rotate_ax_image(rotation)
 img_ax = eng.draw_ROI(horizontal_cut[0], horizontal_cut[1], vertical_cut[0], vertical_cut[1])
 
-img_sa = eng.get_image_sa_at_index(ax_index, imin=eng.data.min(), imax=eng.data.max(), y=tilt1, z=tilt2)
+img_sa = eng.get_image_sa_at_index(ax_index, imin=eng.data_min, imax=eng.data_max, y=tilt1, z=tilt2)
 
 
 img_samp = eng.samp
 img_us = np.zeros((512,512))
 
 if st.sidebar.button("Generate US from sample"):
-    img_us = eng.gen_us()
+    if gan is None:
+        st.sidebar.error("The GAN could not be loaded, see the model status below.")
+    else:
+        img_us = eng.gen_us()
+st.sidebar.text(get_model_holder().status())
 
 col1, col2 = st.beta_columns([3,2])
 with col1:
@@ -31,10 +31,14 @@ class CUTModel(BaseModel):
         parser.add_argument('--netF', type=str, default='mlp_sample', choices=['sample', 'reshape', 'mlp_sample'], help='how to downsample the feature map')
         parser.add_argument('--netF_nc', type=int, default=256)
         parser.add_argument('--nce_T', type=float, default=0.07, help='temperature for NCE loss')
+        parser.add_argument('--nce_fused_logits', type=util.str2bool, nargs='?', const=True, default=False,
+                            help='compute the NCE loss as a log-sum-exp of the positive and negative logits, instead of a cross entropy over their concatenation')
         parser.add_argument('--num_patches', type=int, default=256, help='number of patches per layer')
         parser.add_argument('--flip_equivariance',
                             type=util.str2bool, nargs='?', const=True, default=False,
                             help="Enforce flip-equivariance as additional regularization. It's used by FastCUT, but not CUT")
+        parser.add_argument('--reuse_nce_features', type=util.str2bool, nargs='?', const=True, default=False,
+                            help='keep the nce_layers features of the source images computed by the forward pass of netG for the NCE loss, instead of encoding them again (not with --normG batch, whose statistics then include the nce_idt images)')
 
         parser.set_defaults(pool_size=0)  # no image pooling
 
@@ -151,7 +155,16 @@ class CUTModel(BaseModel):
             if self.flipped_for_equivariance:
                 self.real = torch.flip(self.real, [3])
 
-        self.fake = self.netG(self.real)
+        # the NCE loss encodes real_A (and real_B) with netG: keep those features from this pass instead,
+        # unless the images were flipped, as the NCE keys are the features of the unflipped images
+        self.feat_k_A, self.feat_k_B = None, None
+        if self.opt.isTrain and self.opt.reuse_nce_features and self.opt.lambda_NCE > 0.0 and not (self.opt.flip_equivariance and self.flipped_for_equivariance):
+            self.fake, feats = self.netG(self.real, list(self.nce_layers))
+            self.feat_k_A = [feat[:self.real_A.size(0)] for feat in feats]
+            if self.opt.nce_idt:
+                self.feat_k_B = [feat[self.real_A.size(0):] for feat in feats]
+        else:
+            self.fake = self.netG(self.real)
         self.fake_B = self.fake[:self.real_A.size(0)]
         if self.opt.nce_idt:
             self.idt_B = self.fake[self.real_A.size(0):]
@@ -182,12 +195,12 @@ class CUTModel(BaseModel):
             self.loss_G_GAN = 0.0
 
         if self.opt.lambda_NCE > 0.0:
-            self.loss_NCE = self.calculate_NCE_loss(self.real_A, self.fake_B)
+            self.loss_NCE = self.calculate_NCE_loss(self.real_A, self.fake_B, self.feat_k_A)
         else:
             self.loss_NCE, self.loss_NCE_bd = 0.0, 0.0
 
         if self.opt.nce_idt and self.opt.lambda_NCE > 0.0:
-            self.loss_NCE_Y = self.calculate_NCE_loss(self.real_B, self.idt_B)
+            self.loss_NCE_Y = self.calculate_NCE_loss(self.real_B, self.idt_B, self.feat_k_B)
             loss_NCE_both = (self.loss_NCE + self.loss_NCE_Y) * 0.5
         else:
             loss_NCE_both = self.loss_NCE
@@ -195,14 +208,19 @@ class CUTModel(BaseModel):
         self.loss_G = self.loss_G_GAN + loss_NCE_both
         return self.loss_G
 
-    def calculate_NCE_loss(self, src, tgt):
+    def calculate_NCE_loss(self, src, tgt, feat_k=None):
+        """Calculate the PatchNCE loss between the nce_layers features of <src> and <tgt>.
+
+        feat_k, if given, are the features of <src> already computed by netG (see --reuse_nce_features).
+        """
         n_layers = len(self.nce_layers)
         feat_q = self.netG(tgt, self.nce_layers, encode_only=True)
 
         if self.opt.flip_equivariance and self.flipped_for_equivariance:
             feat_q = [torch.flip(fq, [3]) for fq in feat_q]
 
-        feat_k = self.netG(src, self.nce_layers, encode_only=True)
+        if feat_k is None:
+            feat_k = self.netG(src, self.nce_layers, encode_only=True)
         feat_k_pool, sample_ids = self.netF(feat_k, self.opt.num_patches, None)
         feat_q_pool, _ = self.netF(feat_q, self.opt.num_patches, sample_ids)
 
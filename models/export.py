@@ -0,0 +1,219 @@
+"""Export the generator of a trained model to inference-only backends.
+
+The exported files are stored next to the checkpoint they come from, e.g.
+'./checkpoints/ct2us_qt/265_net_G.torchscript.pt' or '265_net_G.onnx' for '265_net_G.pth',
+and are re-exported whenever the checkpoint is newer (see <get_exported_generator>).
+The ONNX backend needs the onnx and onnxruntime packages. The int8 backend is produced by
+calibrating on sample images (see <quantize_generator> and export.py) and cannot be exported
+on the fly.
+"""
+import copy
+import inspect
+import os
+import torch
+import torch.nn as nn
+from . import networks
+
+
+EXTENSIONS = {'torchscript': 'torchscript.pt', 'onnx': 'onnx', 'int8': 'int8.pt'}
+
+
+def unwrap(net):
+    """Return the module inside a DataParallel wrapper (see BaseModel.parallelize)."""
+    return net.module if isinstance(net, torch.nn.DataParallel) else net
+
+
+def traceable(net):
+    """Return <net>, or a copy using the reference Downsample/Upsample if it uses another --blur_impl.
+
+    The folded blur layers fix their border outputs in place, in views of their output, which
+    optimize_for_inference and the ONNX exporter do not preserve.
+    """
+    if any(isinstance(m, (networks.FoldedDownsample, networks.FoldedUpsample)) for m in net.modules()):
+        net = networks.set_blur_impl(copy.deepcopy(net), 'reference')
+    return net
+
+
+def export_path(opt, backend):
+    """Return the path of the <backend> export of the generator described by <opt>."""
+    suffix = '_gray' if getattr(opt, 'grayscale_input', False) else ''
+    return os.path.join(opt.checkpoints_dir, opt.name, '%s_net_G%s.%s' % (opt.epoch, suffix, EXTENSIONS[backend]))
+
+
+def dummy_input(net, input_nc, size, batch_size=1):
+    return torch.zeros(batch_size, input_nc, size, size, device=next(net.parameters()).device)
+
+
+def export_torchscript(netG, path, input_nc=3, size=256):
+    """Trace <netG> into a TorchScript module, save it to <path> and return it.
+
+    Only the layers of the generator are traced (its 'model' Sequential when it has one), so the
+    feature-extraction branches of ResnetGenerator.forward (layers, encode_only) are not part of
+    the graph. The module is frozen when the installed torch provides torch.jit.freeze (1.7 and
+    later); it is optimized for inference when loaded (see <load_torchscript>), as optimized
+    graphs cannot always be serialized.
+
+    Parameters:
+        netG (network)  -- the generator, possibly wrapped in DataParallel
+        path (str)      -- where the module is saved
+        input_nc (int)  -- number of channels of the input images
+        size (int)      -- size of the dummy image used for tracing; any size works afterwards
+    """
+    net = unwrap(netG)
+    net = traceable(getattr(net, 'model', net))
+    training = net.training
+    net.eval()
+    with torch.no_grad():
+        module = torch.jit.trace(net, dummy_input(net, input_nc, size))
+    net.train(training)
+    if hasattr(torch.jit, 'freeze'):
+        module = torch.jit.freeze(module)
+    torch.jit.save(module, path)
+    return load_torchscript(path, next(net.parameters()).device)
+
+
+def load_torchscript(path, device):
+    """Load a TorchScript module saved by <export_torchscript>, optimized for inference when torch allows it (1.9 and later)."""
+    module = torch.jit.load(path, map_location=device).eval()
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        module = torch.jit.optimize_for_inference(module)
+    return module
+
+
+def export_onnx(netG, path, input_nc=3, size=256, opset=13):
+    """Export <netG> to ONNX at <path>, with dynamic batch size, height and width.
+
+    As for <export_torchscript>, only the layers are traced. The antialiased Downsample/Upsample
+    layers export as grouped Conv/ConvTranspose with their fixed filters, and the reflection and
+    replication pads as Pad in reflect/edge mode, which needs opset 11 or later.
+
+    Parameters:
+        netG (network)  -- the generator, possibly wrapped in DataParallel
+        path (str)      -- where the model is saved
+        input_nc (int)  -- number of channels of the input images
+        size (int)      -- size of the dummy image used for tracing
+        opset (int)     -- ONNX opset version
+    """
+    assert opset >= 11, 'reflection padding needs ONNX opset 11 or later'
+    net = unwrap(netG)
+    net = traceable(getattr(net, 'model', net))
+    training = net.training
+    net.eval()
+    # newer torch defaults to the dynamo exporter, which needs onnxscript; the traced graph is all we need
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    with torch.no_grad():
+        torch.onnx.export(net, dummy_input(net, input_nc, size), path, input_names=['real_A'], output_names=['fake_B'],
+                          dynamic_axes={'real_A': axes, 'fake_B': axes}, opset_version=opset, do_constant_folding=True, **options)
+    net.train(training)
+
+
+def quantization_engine():
+    """Return the quantized engine used for int8 inference on this machine (fbgemm/x86 on x86 CPUs, qnnpack on ARM)."""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in engines:
+            return engine
+    raise RuntimeError('this torch build has no quantized engine')
+
+
+def quantize_generator(netG, calibration, keep_first_last=True):
+    """Return an int8 post-training quantized copy of the layers of <netG>, calibrated on <calibration>.
+
+    The quantization is mixed precision: each standard nn.Conv2d is wrapped in a QuantWrapper
+    (quantize -> int8 conv with per-channel weights -> dequantize), and everything else stays
+    in float. That covers InstanceNorm2d (its statistics are computed per image, which int8
+    kernels do not support), the reflection pads, and the depthwise blur of Downsample/Upsample,
+    which are functional convs with fixed filters and few MACs. The 7x7 first and last convs
+    are kept in float by default, as they matter most for the image quality.
+
+    Parameters:
+        netG (network)          -- the float generator, possibly wrapped in DataParallel
+        calibration (iterable)  -- batches of normalised input tensors, run to calibrate the activation observers
+        keep_first_last (bool)  -- keep the first and last convolutions in float
+    """
+    engine = quantization_engine()
+    torch.backends.quantized.engine = engine
+    qconfig = torch.quantization.get_default_qconfig(engine)
+
+    net = unwrap(netG)
+    net = networks.set_blur_impl(copy.deepcopy(getattr(net, 'model', net)), 'reference').cpu().eval()
+    convs = [m for m in net.modules() if type(m) is nn.Conv2d]
+    skip = {id(convs[0]), id(convs[-1])} if keep_first_last else set()
+
+    def wrap(module):
+        for name, child in module.named_children():
+            if type(child) is nn.Conv2d and id(child) not in skip:
+                wrapper = torch.quantization.QuantWrapper(child)
+                wrapper.qconfig = qconfig
+                setattr(module, name, wrapper)
+            else:
+                wrap(child)
+    wrap(net)
+
+    torch.quantization.prepare(net, inplace=True)
+    with torch.no_grad():
+        for batch in calibration:
+            net(batch.cpu())
+    torch.quantization.convert(net, inplace=True)
+    return net
+
+
+def export_int8(netG, path, calibration, input_nc=3, size=256, keep_first_last=True):
+    """Quantize <netG> (see <quantize_generator>), save it to <path> as TorchScript and return it.
+
+    The quantized TorchScript module is the int8 checkpoint format: it holds the int8 weights and
+    calibrated scales, and is loaded with <load_int8> without rebuilding the network.
+    """
+    net = quantize_generator(netG, calibration, keep_first_last)
+    with torch.no_grad():
+        module = torch.jit.trace(net, torch.zeros(1, input_nc, size, size))
+    torch.jit.save(module, path)
+    return load_int8(path)
+
+
+def load_int8(path):
+    """Load an int8 generator saved by <export_int8> (CPU only)."""
+    torch.backends.quantized.engine = quantization_engine()
+    return torch.jit.load(path, map_location='cpu').eval()
+
+
+class OnnxModule(torch.nn.Module):
+    """Expose an ONNX export run by onnxruntime (see util/onnx_runtime.py) as a generator taking and returning tensors."""
+
+    def __init__(self, path, threads=0):
+        super(OnnxModule, self).__init__()
+        from util.onnx_runtime import OnnxGenerator
+        self.runner = OnnxGenerator(path, threads)
+
+    def forward(self, input):
+        return torch.from_numpy(self.runner(input.detach().cpu().numpy())).to(input.device)
+
+
+def get_exported_generator(model, opt, backend):
+    """Return the <backend> export of model.netG, exporting it first if it is missing or older than the checkpoint."""
+    path = export_path(opt, backend)
+    checkpoint = os.path.join(opt.checkpoints_dir, opt.name, '%s_net_G.pth' % opt.epoch)
+    if backend == 'int8':
+        # needs calibration images, see export.py
+        assert os.path.exists(path), 'no int8 generator at %s, create it with export.py --backend int8' % path
+        return load_int8(path)
+    if not os.path.exists(path) or (os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > os.path.getmtime(path)):
+        print('exporting the generator to %s' % path)
+        if backend == 'torchscript':
+            export_torchscript(model.netG, path, opt.input_nc, opt.crop_size)
+        elif backend == 'onnx':
+            export_onnx(model.netG, path, opt.input_nc, opt.crop_size)
+    if backend == 'torchscript':
+        return load_torchscript(path, model.device)
+    if backend == 'onnx':
+        return OnnxModule(path)
+    raise NotImplementedError('backend [%s] is not supported' % backend)
+
+
+def max_difference(reference, exported, input_nc=3, size=256, batch_size=2):
+    """Return the largest absolute difference between the outputs of two generators on random images."""
+    net = unwrap(reference)
+    real = torch.rand(batch_size, input_nc, size, size, device=next(net.parameters()).device) * 2 - 1
+    with torch.no_grad():
+        return (net(real) - exported(real)).abs().max().item()
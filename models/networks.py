@@ -5,7 +5,7 @@ from torch.nn import init
 import functools
 from torch.optim import lr_scheduler
 import numpy as np
-from .stylegan_networks import StyleGAN2Discriminator, StyleGAN2Generator, TileStyleGAN2Discriminator
+from .stylegan_networks import StyleGAN2Discriminator, StyleGAN2Generator, TileStyleGAN2Discriminator, set_upfirdn2d_impl
 
 ###############################################################################
 # Helper Functions
@@ -93,6 +93,147 @@ class Upsample(nn.Module):
             return ret_val[:, :, :-1, :-1]
 
 
+def separable_filters(filt):
+    """Split a (C, 1, k, k) rank-1 blur filter into its (C, 1, k, 1) vertical and (C, 1, 1, k) horizontal factors."""
+    rows = filt.sum(dim=3, keepdim=True)
+    cols = filt.sum(dim=2, keepdim=True) / filt.sum(dim=(2, 3), keepdim=True)
+    return rows, cols
+
+
+def fix_borders(out, inp, reference, borders):
+    """Overwrite the border outputs of <out> with those of <reference> run on thin bands of <inp>.
+
+    Parameters:
+        out (tensor)           -- output of a blur with zero padding, modified in place
+        inp (tensor)           -- input of the blur
+        reference (function)   -- the reference blur, which pads <inp> itself
+        borders (list)         -- (dim, front, back, band_front, band_back) for dims 2 and 3: the number of wrong
+                                  outputs at each end, and the number of inputs the reference needs to compute them
+    """
+    for dim, front, back, band_front, band_back in borders:
+        size = inp.shape[dim]
+        if front > 0:
+            band = inp.narrow(dim, 0, min(size, band_front))
+            out.narrow(dim, 0, front).copy_(reference(band).narrow(dim, 0, front))
+        if back > 0:
+            band = inp.narrow(dim, size - min(size, band_back), min(size, band_back))
+            ref = reference(band)
+            out.narrow(dim, out.shape[dim] - back, back).copy_(ref.narrow(dim, ref.shape[dim] - back, back))
+    return out
+
+
+class FoldedDownsample(Downsample):
+    """Downsample with the pad folded into the convolution, optionally as two 1D passes.
+
+    The reference Downsample pads its input into a new tensor before the depthwise convolution, which
+    costs as much as the convolution on the large activations of the first layers. Here the convolution
+    pads with zeros by itself, and the few outputs whose window reaches into the padding are computed
+    again by the reference on thin bands of the input, so reflect/replicate padding give the same result.
+    With <separable>, the binomial filter (an outer product of 1D filters) is applied as a 1 x k then a
+    k x 1 pass. Only symmetric pads (odd filter sizes) are folded, other layers run the reference code.
+    The filt buffer is kept, so state_dict keys and checkpoints are those of Downsample.
+    """
+
+    def __init__(self, channels, pad_type='reflect', filt_size=3, stride=2, pad_off=0, separable=False):
+        super(FoldedDownsample, self).__init__(channels, pad_type, filt_size, stride, pad_off)
+        self.separable = separable
+        self.zero_pad = type(self.pad) is nn.ZeroPad2d
+
+    def forward(self, inp):
+        left, right, top, bottom = self.pad_sizes
+        if self.filt_size == 1 or left != right or top != bottom:
+            return super(FoldedDownsample, self).forward(inp)
+        groups = inp.shape[1]
+        if self.separable:
+            rows, cols = separable_filters(self.filt)
+            out = F.conv2d(inp, cols, stride=(1, self.stride), padding=(0, left), groups=groups)
+            out = F.conv2d(out, rows, stride=(self.stride, 1), padding=(top, 0), groups=groups)
+        else:
+            out = F.conv2d(inp, self.filt, stride=self.stride, padding=(top, left), groups=groups)
+        if self.zero_pad:
+            return out
+        borders = []
+        for dim, pad in [(2, top), (3, left)]:
+            size, n, k, s = inp.shape[dim], out.shape[dim], self.filt_size, self.stride
+            front = min(-(-pad // s), n)
+            back = n - max(-(-(pad + size - k + 1) // s), front)
+            # the back band starts on the output grid, at least ceil(pad / s) outputs before the first wrong
+            # one, and is larger than the pad (reflect needs it)
+            start = max(min(n - back - front, (size - pad - 1) // s), 0) * s
+            borders.append((dim, front, back, front * s + k, size - start))
+        return fix_borders(out, inp, super(FoldedDownsample, self).forward, borders)
+
+
+class FoldedUpsample(Upsample):
+    """Upsample with the pad and the crop folded into the transposed convolution, optionally as two 1D passes.
+
+    See FoldedDownsample. The reference crops its output, which leaves a strided view that the next
+    convolution copies; here the transposed convolution directly gives the cropped output. Layers whose
+    crop cannot be expressed as padding/output_padding (strides above 2) run the reference code.
+    """
+
+    def __init__(self, channels, pad_type='repl', filt_size=4, stride=2, separable=False):
+        super(FoldedUpsample, self).__init__(channels, pad_type, filt_size, stride)
+        self.separable = separable
+        self.zero_pad = type(self.pad) is nn.ZeroPad2d
+
+    def forward(self, inp):
+        k, s = self.filt_size, self.stride
+        # the reference crops 2 + pad_size outputs in front of the transposed convolution of the padded input,
+        # that is 2 + pad_size - stride in front of the one of the input itself
+        front_crop = 2 + self.pad_size - s
+        back_crop = self.pad_size + 1 - s + (0 if self.filt_odd else 1)
+        if front_crop < 0 or not 0 <= front_crop - back_crop < s:
+            return super(FoldedUpsample, self).forward(inp)
+        groups, extra = inp.shape[1], front_crop - back_crop
+        if self.separable:
+            rows, cols = separable_filters(self.filt)
+            out = F.conv_transpose2d(inp, cols, stride=(1, s), padding=(0, front_crop), output_padding=(0, extra), groups=groups)
+            out = F.conv_transpose2d(out, rows, stride=(s, 1), padding=(front_crop, 0), output_padding=(extra, 0), groups=groups)
+        else:
+            out = F.conv_transpose2d(inp, self.filt, stride=s, padding=front_crop, output_padding=extra, groups=groups)
+        if self.zero_pad:
+            return out
+        borders = []
+        for dim in [2, 3]:
+            n = out.shape[dim]
+            front = min(max(k - 2 - self.pad_size, 0), n)
+            back = min(max(n - (inp.shape[dim] + 1) * s + 2 + self.pad_size, 0), n)
+            borders.append((dim, front, back, front + k, back + k))
+        return fix_borders(out, inp, super(FoldedUpsample, self).forward, borders)
+
+
+BLUR_LAYERS = {'reference': (Downsample, Upsample), 'folded': (FoldedDownsample, FoldedUpsample), 'separable': (FoldedDownsample, FoldedUpsample)}
+
+
+def set_blur_impl(net, impl='reference'):
+    """Switch the antialiasing Downsample/Upsample layers of <net> to another implementation, in place.
+
+    The new layers take over the filt buffer of the ones they replace, so this can be done before or
+    after loading a checkpoint, and state_dict keys are unchanged.
+
+    Parameters:
+        net (network) -- the network to rewrite, e.g. a ResnetGenerator
+        impl (str)    -- reference (Downsample/Upsample) | folded | separable (see FoldedDownsample)
+
+    Returns the network.
+    """
+    down, up = BLUR_LAYERS[impl]
+    options = {'separable': True} if impl == 'separable' else {}
+    for module in list(net.modules()):
+        for name, child in module.named_children():
+            if not isinstance(child, (Downsample, Upsample)):
+                continue
+            pad_type = {nn.ReflectionPad2d: 'reflect', nn.ReplicationPad2d: 'replicate', nn.ZeroPad2d: 'zero'}[type(child.pad)]
+            if isinstance(child, Downsample):
+                layer = down(child.channels, pad_type, child.filt_size, child.stride, child.pad_off, **options)
+            else:
+                layer = up(child.channels, pad_type, child.filt_size, child.stride, **options)
+            layer.filt = child.filt
+            setattr(module, name, layer)
+    return net
+
+
 def get_pad_layer(pad_type):
     if(pad_type in ['refl', 'reflect']):
         PadLayer = nn.ReflectionPad2d
@@ -265,9 +406,66 @@ def define_G(input_nc, output_nc, ngf, netG, norm='batch', use_dropout=False, in
         net = G_Resnet(input_nc, output_nc, opt.nz, num_downs=2, n_res=n_blocks - 4, ngf=ngf, norm='inst', nl_layer='relu')
     else:
         raise NotImplementedError('Generator model name [%s] is not recognized' % netG)
+    if getattr(opt, 'fuse_reflect_pad', False):
+        fuse_reflect_padding(net)
+    if getattr(opt, 'blur_impl', 'reference') != 'reference':
+        set_blur_impl(net, opt.blur_impl)
+    if 'stylegan2' in netG:
+        set_upfirdn2d_impl(net, getattr(opt, 'upfirdn2d_impl', 'native'))
     return init_net(net, init_type, init_gain, gpu_ids, initialize_weights=('stylegan2' not in netG))
 
 
+def fold_input_channels(net):
+    """Fold the input channels of the first convolution of <net> into a single channel, in place.
+
+    A grayscale image converted to RGB and normalised with the same mean/std per channel gives an
+    input whose channels are all equal. For such an input, a convolution over the C channels is the
+    same as a 1-channel convolution whose weights are summed over the input channels, so the folded
+    network gives identical outputs from the 1-channel image, with a third of the first layer's FLOPs.
+
+    Parameters:
+        net (network) -- the network to fold, e.g. a loaded ResnetGenerator (not wrapped in DataParallel)
+
+    Returns the network, which now takes 1-channel inputs.
+    """
+    conv = next(m for m in net.modules() if isinstance(m, nn.Conv2d))
+    assert conv.groups == 1, 'cannot fold the input channels of a grouped convolution'
+    with torch.no_grad():
+        conv.weight = nn.Parameter(conv.weight.sum(dim=1, keepdim=True))
+    conv.in_channels = 1
+    return net
+
+
+def fuse_reflect_padding(net):
+    """Merge each ReflectionPad2d followed by an unpadded Conv2d into a Conv2d with padding_mode='reflect', in place.
+
+    The merged convolution shares the weight and bias of the original one and the pad is replaced
+    by an Identity, so layer indices (e.g. --nce_layers) and state_dict keys are unchanged and
+    checkpoints load before or after the merge. Outputs are identical. PyTorch still pads the input
+    inside Conv2d.forward for non-zero padding modes, so this mostly saves module calls; exporters
+    (TorchScript, ONNX) see a single convolution.
+
+    Parameters:
+        net (network) -- the network to rewrite, e.g. a ResnetGenerator and its ResnetBlocks
+
+    Returns the network.
+    """
+    for seq in [m for m in net.modules() if isinstance(m, nn.Sequential)]:
+        for i in range(len(seq) - 1):
+            pad, conv = seq[i], seq[i + 1]
+            if not (type(pad) is nn.ReflectionPad2d and type(conv) is nn.Conv2d):
+                continue
+            left, right, top, bottom = pad.padding
+            if conv.padding != (0, 0) or conv.padding_mode != 'zeros' or left != right or top != bottom:
+                continue
+            fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=(top, left),
+                              dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None, padding_mode='reflect')
+            fused.weight = conv.weight
+            fused.bias = conv.bias
+            seq[i], seq[i + 1] = Identity(), fused
+    return net
+
+
 def define_F(input_nc, netF, norm='batch', use_dropout=False, init_type='normal', init_gain=0.02, no_antialias=False, gpu_ids=[], opt=None):
     if netF == 'global_pool':
         net = PoolingF()
@@ -327,6 +525,8 @@ def define_D(input_nc, ndf, netD, n_layers_D=3, norm='batch', init_type='normal'
         net = StyleGAN2Discriminator(input_nc, ndf, n_layers_D, no_antialias=no_antialias, opt=opt)
     else:
         raise NotImplementedError('Discriminator model name [%s] is not recognized' % netD)
+    if 'stylegan2' in netD:
+        set_upfirdn2d_impl(net, getattr(opt, 'upfirdn2d_impl', 'native'))
     return init_net(net, init_type, init_gain, gpu_ids,
                     initialize_weights=('stylegan2' not in netD))
 
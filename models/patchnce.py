@@ -9,11 +9,23 @@ class PatchNCELoss(nn.Module):
         self.opt = opt
         self.cross_entropy_loss = torch.nn.CrossEntropyLoss(reduction='none')
         self.mask_dtype = torch.uint8 if version.parse(torch.__version__) < version.parse('1.2.0') else torch.bool
+        self.cache = {}
+
+    def cached(self, name, size, device, dtype, make):
+        """Return the tensor built by <make>(), once per (<name>, <size>, <device>, <dtype>)."""
+        key = (name, size, device, dtype)
+        if key not in self.cache:
+            self.cache[key] = make()
+        return self.cache[key]
 
     def forward(self, feat_q, feat_k):
         batchSize = feat_q.shape[0]
         dim = feat_q.shape[1]
         feat_k = feat_k.detach()
+        # with nce_fused_logits, the temperature is applied to the queries, so the logits come out scaled
+        fused = getattr(self.opt, 'nce_fused_logits', False)
+        if fused:
+            feat_q = feat_q / self.opt.nce_T
 
         # pos logit
         l_pos = torch.bmm(feat_q.view(batchSize, 1, -1), feat_k.view(batchSize, -1, 1))
@@ -42,13 +54,21 @@ class PatchNCELoss(nn.Module):
 
         # diagonal entries are similarity between same features, and hence meaningless.
         # just fill the diagonal with very small number, which is exp(-10) and almost zero
-        diagonal = torch.eye(npatches, device=feat_q.device, dtype=self.mask_dtype)[None, :, :]
-        l_neg_curbatch.masked_fill_(diagonal, -10.0)
+        diagonal = self.cached('diagonal', npatches, feat_q.device, self.mask_dtype,
+                               lambda: torch.eye(npatches, device=feat_q.device, dtype=self.mask_dtype)[None, :, :])
+        l_neg_curbatch.masked_fill_(diagonal, -10.0 / self.opt.nce_T if fused else -10.0)
         l_neg = l_neg_curbatch.view(-1, npatches)
 
+        if fused:
+            # cross entropy with the positive as target, without concatenating the logits:
+            # logsumexp([l_pos, l_neg]) - l_pos
+            l_pos = l_pos.view(-1)
+            return torch.logaddexp(l_pos, torch.logsumexp(l_neg, dim=1)) - l_pos
+
         out = torch.cat((l_pos, l_neg), dim=1) / self.opt.nce_T
 
-        loss = self.cross_entropy_loss(out, torch.zeros(out.size(0), dtype=torch.long,
-                                                        device=feat_q.device))
+        labels = self.cached('labels', out.size(0), feat_q.device, torch.long,
+                             lambda: torch.zeros(out.size(0), dtype=torch.long, device=feat_q.device))
+        loss = self.cross_entropy_loss(out, labels)
 
         return loss
@@ -14,10 +14,44 @@ from torch import nn
 from torch.nn import functional as F
 
 
-def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
+def fused_leaky_relu_native(input, bias, negative_slope=0.2, scale=2 ** 0.5):
     return F.leaky_relu(input + bias, negative_slope) * scale
 
 
+class FusedLeakyReLUFunction(torch.autograd.Function):
+    """leaky_relu(input + bias) * scale with a single output tensor.
+
+    fused_leaky_relu_native allocates a tensor for the bias add, one for leaky_relu and one for
+    the scale, and keeps the first for backward. Here the activation and the scale are applied in
+    place on the result of the bias add, and only that output is saved: as scale > 0, the sign of
+    the output gives the slope of each element. The backward is made of differentiable ops, so
+    gradient penalties (create_graph=True, e.g. the R1 penalty of SinCUT) still work.
+    """
+
+    @staticmethod
+    def forward(ctx, input, bias, negative_slope, scale):
+        out = input + bias
+        F.leaky_relu(out, negative_slope, inplace=True)
+        out.mul_(scale)
+        ctx.save_for_backward(out)
+        ctx.negative_slope = negative_slope
+        ctx.scale = scale
+        ctx.bias_shape = bias.shape
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        out, = ctx.saved_tensors
+        # out has the sign of input + bias, which is all leaky_relu_backward looks at
+        grad_input = torch.ops.aten.leaky_relu_backward(grad_output, out, ctx.negative_slope, False).mul_(ctx.scale)
+        grad_bias = grad_input.sum_to_size(ctx.bias_shape) if ctx.needs_input_grad[1] else None
+        return grad_input, grad_bias, None, None
+
+
+def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5):
+    return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
+
+
 class FusedLeakyReLU(nn.Module):
     def __init__(self, channel, negative_slope=0.2, scale=2 ** 0.5):
         super().__init__()
@@ -71,8 +105,54 @@ def upfirdn2d_native(
     return out[:, :, ::down_y, ::down_x]
 
 
-def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
-    return upfirdn2d_native(input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
+def upfirdn2d_grouped(
+    input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
+):
+    """Same as upfirdn2d_native, computed with a depthwise convolution over the channels.
+
+    upfirdn2d_native runs a single-channel conv2d over batch x channels images, after upsampling
+    by padding a 6D view with zeros. Here the kernel is repeated per channel and applied with a
+    grouped conv2d, strided by <down>. When upsampling, the zero insertion and the convolution are
+    a single strided conv_transpose2d, whose output is cropped (or padded) to the native one with
+    its padding argument and F.pad with negative pads.
+    """
+    channels = input.shape[1]
+    kernel_h, kernel_w = kernel.shape
+
+    if up_x == 1 and up_y == 1:
+        w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w).repeat(channels, 1, 1, 1)
+        if pad_x0 == pad_x1 >= 0 and pad_y0 == pad_y1 >= 0:
+            return F.conv2d(input, w, stride=(down_y, down_x), padding=(pad_y0, pad_x0), groups=channels)
+        out = F.pad(input, [pad_x0, pad_x1, pad_y0, pad_y1])
+        return F.conv2d(out, w, stride=(down_y, down_x), groups=channels)
+
+    # the full transposed convolution starts kernel - 1 - pad0 samples before the native output,
+    # and ends kernel - up - pad1 samples after it
+    w = kernel.view(1, 1, kernel_h, kernel_w).repeat(channels, 1, 1, 1)
+    crop = [kernel_w - 1 - pad_x0, kernel_w - up_x - pad_x1, kernel_h - 1 - pad_y0, kernel_h - up_y - pad_y1]
+    padding = (max(min(crop[2], crop[3]), 0), max(min(crop[0], crop[1]), 0))
+    out = F.conv_transpose2d(input, w, stride=(up_y, up_x), padding=padding, groups=channels)
+    crop = [crop[0] - padding[1], crop[1] - padding[1], crop[2] - padding[0], crop[3] - padding[0]]
+    if any(crop):
+        out = F.pad(out, [-c for c in crop])
+
+    return out[:, :, ::down_y, ::down_x]
+
+
+UPFIRDN2D = {'native': upfirdn2d_native, 'grouped': upfirdn2d_grouped}
+
+
+def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), impl='native'):
+    return UPFIRDN2D[impl](input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
+
+
+def set_upfirdn2d_impl(net, impl='native'):
+    """Select the upfirdn2d implementation (native | grouped) of the Blur, Upsample and Downsample layers of <net>, in place."""
+    assert impl in UPFIRDN2D, 'upfirdn2d implementation [%s] is not recognized' % impl
+    for m in net.modules():
+        if isinstance(m, (Blur, Upsample, Downsample)):
+            m.impl = impl
+    return net
 
 
 class PixelNorm(nn.Module):
@@ -108,9 +188,10 @@ class Upsample(nn.Module):
         pad1 = p // 2
 
         self.pad = (pad0, pad1)
+        self.impl = 'native'
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, up=self.factor, down=1, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, up=self.factor, down=1, pad=self.pad, impl=self.impl)
 
         return out
 
@@ -129,9 +210,10 @@ class Downsample(nn.Module):
         pad1 = p // 2
 
         self.pad = (pad0, pad1)
+        self.impl = 'native'
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, up=1, down=self.factor, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, up=1, down=self.factor, pad=self.pad, impl=self.impl)
 
         return out
 
@@ -148,9 +230,10 @@ class Blur(nn.Module):
         self.register_buffer('kernel', kernel)
 
         self.pad = pad
+        self.impl = 'native'
 
     def forward(self, input):
-        out = upfirdn2d(input, self.kernel, pad=self.pad)
+        out = upfirdn2d(input, self.kernel, pad=self.pad, impl=self.impl)
 
         return out
 
@@ -306,7 +389,7 @@ class ModulatedConv2d(nn.Module):
         if style is not None:
             style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
         else:
-            style = torch.ones(batch, 1, in_channel, 1, 1).cuda()
+            style = torch.ones(batch, 1, in_channel, 1, 1, device=input.device)
         weight = self.scale * self.weight * style
 
         if self.demodulate:
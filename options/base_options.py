@@ -68,6 +68,8 @@ class BaseOptions():
         parser.add_argument('--stylegan2_G_num_downsampling',
                             default=1, type=int,
                             help='Number of downsampling layers used by StyleGAN2Generator')
+        parser.add_argument('--upfirdn2d_impl', type=str, default='native', choices=['native', 'grouped'],
+                            help='implementation of the blur/upsample/downsample layers of the StyleGAN2 networks: native (single-channel conv over batch x channels) | grouped (depthwise conv and conv_transpose2d)')
 
         self.initialized = True
         return parser
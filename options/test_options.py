@@ -14,6 +14,10 @@ class TestOptions(BaseOptions):
         # Dropout and Batchnorm has different behavioir during training and test.
         parser.add_argument('--eval', action='store_true', help='use eval mode during test time.')
         parser.add_argument('--num_test', type=int, default=50, help='how many test images to run')
+        parser.add_argument('--fuse_reflect_pad', action='store_true', help='merge the ReflectionPad2d + Conv2d pairs of the generator into Conv2d with reflect padding (same outputs and checkpoints)')
+        parser.add_argument('--grayscale_input', action='store_true', help='fold the first convolution of the generator to take 1-channel grayscale inputs instead of RGB images with equal channels (same outputs)')
+        parser.add_argument('--blur_impl', type=str, default='reference', choices=['reference', 'folded', 'separable'], help='implementation of the antialiasing blur of the Downsample/Upsample layers: reference | pad folded into the convolution | folded and as two 1D passes (same outputs up to float rounding, same checkpoints)')
+        parser.add_argument('--backend', type=str, default='eager', choices=['eager', 'torchscript', 'onnx', 'int8'], help='runs the generator in eager mode, or from its TorchScript, ONNX (onnxruntime) or int8 quantized export saved next to the checkpoint (see models/export.py)')
 
         # To avoid cropping, the load_size should be the same as crop_size
         parser.set_defaults(load_size=parser.get_default('crop_size'))
@@ -27,9 +27,14 @@ See training and test tips at: https://github.com/junyanz/pytorch-CycleGAN-and-p
 See frequently asked questions at: https://github.com/junyanz/pytorch-CycleGAN-and-pix2pix/blob/master/docs/qa.md
 """
 import os
+import threading
+import numpy as np
+import torch
 from options.test_options import TestOptions
 from data import create_dataset
-from models import create_model
+from data.base_dataset import get_transform
+from models import create_model, networks
+from models.export import get_exported_generator
 from util.visualizer import save_images
 from util import html
 import util.util as util
@@ -37,7 +42,7 @@ import util.util as util
 from PIL import Image
 
 class CUTTestWrapper():
-    def __init__(self, data_path='/home/hadrien/Bureau/PhD Year 1/Research/LUNG_CT/ct_explorer/tmp_ct_to_us', name='ct2us_qt', phase='test', epoch_to_load=265, gpu=True):
+    def __init__(self, data_path='/home/hadrien/Bureau/PhD Year 1/Research/LUNG_CT/ct_explorer/tmp_ct_to_us', name='ct2us_qt', phase='test', epoch_to_load=265, gpu=True, warmup=False, backend=None):
     
         self.opt = TestOptions().parse()
         
@@ -58,13 +63,84 @@ class CUTTestWrapper():
         
         if gpu==False:
             self.opt.gpu_ids= []
+        if backend is not None:
+            self.opt.backend = backend
         print(self.opt.gpu_ids, type(self.opt.gpu_ids))
         
         self.dataset = None #create_dataset(opt)
         # self.train_dataset = None #create_dataset(util.copyconf(opt, phase="train"))
         self.model = create_model(self.opt)
         self.model.setup(self.opt)
+        if self.opt.grayscale_input:
+            networks.fold_input_channels(self.model.netG)
+            self.opt.input_nc = 1  # the datasets and <to_tensor> then load grayscale images
         self.model.parallelize()
+        if self.opt.backend != 'eager':
+            self.model.netG = get_exported_generator(self.model, self.opt, self.opt.backend)
+        # same preprocessing as the test dataset (load_size == crop_size: resize, no crop, no flip)
+        self.transform = get_transform(self.opt, grayscale=(self.opt.input_nc == 1))
+        
+        self.initialized = False
+        self.init_lock = threading.Lock()
+        if warmup:
+            self.initialize()
+
+    def initialize(self, data=None):
+        """Run the model's data_dependent_initialize once, on <data> or on a dummy input.
+
+        Later calls do nothing, so <generate> runs a single forward of netG per image.
+        <translate> calls netG directly and does not need it.
+
+        Parameters:
+            data (dict) -- a dataset item (A, B, A_paths, B_paths); a blank crop_size image if None
+        """
+        with self.init_lock:
+            if self.initialized:
+                return
+            if data is None:
+                size = self.opt.crop_size
+                data = {'A': torch.zeros(1, self.opt.input_nc, size, size), 'B': torch.zeros(1, self.opt.output_nc, size, size),
+                        'A_paths': [''], 'B_paths': ['']}
+            with torch.no_grad():
+                self.model.data_dependent_initialize(data)
+            self.initialized = True
+
+    def to_tensor(self, image):
+        """Convert a CT sample to the normalised input tensor of netG, as the test dataset would.
+
+        Parameters:
+            image (numpy array) -- a 2D grayscale image, uint8 or float in [0, 1]
+        """
+        if image.dtype != np.uint8:
+            image = (image * 255).astype(np.uint8)
+        return self.transform(Image.fromarray(image).convert('L' if self.opt.input_nc == 1 else 'RGB'))
+
+    def translate(self, image):
+        """Return the US image generated from the CT sample <image> (see <to_tensor>).
+
+        Unlike update_data/generate, no file, dataset or model attribute is involved, so
+        concurrent calls (e.g. several sessions of the demo) do not interfere.
+        Returns a (1, output_nc, H, W) tensor in [-1, 1] (see util.tensor2im).
+        """
+        return self.generate_batch([image])
+
+    def generate_batch(self, samples, batch_size=8):
+        """Return the US images generated from a list (or stacked array) of CT samples, in order.
+
+        netG runs on mini-batches of <batch_size> samples: ResnetGenerator is fully convolutional
+        with instance normalization, so each output does not depend on the rest of its batch.
+        Returns a (len(samples), output_nc, H, W) tensor in [-1, 1].
+
+        Parameters:
+            samples (list or numpy array) -- 2D grayscale images (see <to_tensor>), or an (N, H, W) array
+            batch_size (int)              -- number of samples per forward of netG
+        """
+        outputs = []
+        with torch.no_grad():
+            for start in range(0, len(samples), batch_size):
+                real_A = torch.stack([self.to_tensor(image) for image in samples[start:start+batch_size]])
+                outputs.append(self.model.netG(real_A.to(self.model.device)))
+        return torch.cat(outputs)
 
     def update_data(self, rand=None):
         self.dataset = create_dataset(self.opt)
@@ -75,7 +151,7 @@ class CUTTestWrapper():
         print(len(self.dataset))
         for i, data in enumerate(self.dataset):
             if i == 0:
-                self.model.data_dependent_initialize(data)
+                self.initialize(data)  # only does something on the first call
                 # self.model.setup(self.opt)               # regular setup: load and print networks; create schedulers
                 # self.model.parallelize()
                 # if self.opt.eval:
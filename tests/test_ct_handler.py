@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+import CTHandler
+
+
+process_volume = CTHandler.process_volume
+
+
+def crashing_process_volume(in_file, *args, **kwargs):
+    """process_volume, except that the worker dies abruptly on the third volume."""
+    if in_file.endswith('0002.nii.gz'):
+        os._exit(1)
+    return process_volume(in_file, *args, **kwargs)
+
+
+def make_volume(path, seed, shape=(96, 96, 24)):
+    data = np.random.RandomState(seed).randint(-1000, 1000, size=shape).astype(np.int16)
+    nib.save(nib.Nifti1Image(data, np.diag([0.7, 0.7, 1.25, 1.0])), path)
+
+
+class ApplyOnWholeFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.in_path = os.path.join(self.tmp, 'in')
+        self.out_path = os.path.join(self.tmp, 'out')
+        os.mkdir(self.in_path)
+        for i in range(6):
+            make_volume(os.path.join(self.in_path, 'LIDC-IDRI-%04d.nii.gz' % i), i)
+        CTHandler.process_volume = crashing_process_volume
+
+    def tearDown(self):
+        CTHandler.process_volume = process_volume
+        shutil.rmtree(self.tmp)
+
+    def test_dead_worker_does_not_stop_the_batch(self):
+        results = CTHandler.apply_on_whole_folder(self.in_path, self.out_path, workers=2, max_in_flight=1, resume=False)
+        status = {os.path.basename(r['file']): r['status'] for r in results}
+        self.assertEqual(len(results), 6)
+        self.assertEqual(status.pop('LIDC-IDRI-0002.nii.gz'), 'error')
+        self.assertEqual(set(status.values()), {'ok'})
+
+    def test_dead_worker_with_volumes_in_flight(self):
+        results = CTHandler.apply_on_whole_folder(self.in_path, self.out_path, workers=2, max_in_flight=4, resume=False)
+        status = {os.path.basename(r['file']): r['status'] for r in results}
+        self.assertEqual(len(results), 6)
+        # the volumes in flight when the worker died are run again, only the one that kills it fails
+        self.assertEqual(status.pop('LIDC-IDRI-0002.nii.gz'), 'error')
+        self.assertEqual(set(status.values()), {'ok'})
+
+
+if __name__ == '__main__':
+    unittest.main()
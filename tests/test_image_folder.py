@@ -0,0 +1,56 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import CTHandler
+from data.image_folder import load_image, make_dataset, read_shard_index
+
+
+class ShardIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        read_shard_index.cache_clear()
+
+    def tearDown(self):
+        read_shard_index.cache_clear()
+        shutil.rmtree(self.dir)
+
+    def write(self, tag, value, n_slices):
+        writer = CTHandler.ShardWriter(self.dir, tag=tag)
+        for i in range(n_slices):
+            writer.write('0001', i, np.full((4, 5), value, dtype=np.uint8))
+        writer.close()
+
+    def test_latest_write_supersedes_older_ones(self):
+        # '10001' sorts before '9999', the loader must still see the second run
+        self.write('9999', 10, 3)
+        self.write('10001', 20, 2)
+        paths = make_dataset(self.dir)
+        self.assertEqual([os.path.basename(p) for p in paths], ['0001-000', '0001-001'])
+        for path in paths:
+            self.assertEqual(np.asarray(load_image(path)).tolist(), np.full((4, 5), 20).tolist())
+
+    def test_truncated_index(self):
+        # a writer killed in the middle of a volume leaves a half-written last row
+        self.write('1', 10, 3)
+        index_path, = glob.glob(os.path.join(self.dir, 'index-*.csv'))
+        with open(index_path, 'rb+') as f:
+            f.truncate(os.path.getsize(index_path) - 20)
+        paths = make_dataset(self.dir)
+        self.assertEqual([os.path.basename(p) for p in paths], ['0001-000', '0001-001'])
+        self.assertEqual(np.asarray(load_image(paths[1])).max(), 10)
+
+    def test_row_past_the_end_of_its_shard(self):
+        self.write('1', 10, 3)
+        shard, = glob.glob(os.path.join(self.dir, 'shard-*.bin'))
+        with open(shard, 'rb+') as f:
+            f.truncate(os.path.getsize(shard) - 1)
+        self.assertEqual([os.path.basename(p) for p in make_dataset(self.dir)], ['0001-000', '0001-001'])
+
+if __name__ == '__main__':
+    unittest.main()
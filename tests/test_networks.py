@@ -0,0 +1,41 @@
+import copy
+import itertools
+import unittest
+
+import torch
+
+from models import networks
+
+
+class BlurParityTest(unittest.TestCase):
+    """The folded and separable Downsample/Upsample (see networks.set_blur_impl) against the reference layers."""
+
+    sizes = [(1, 1), (2, 3), (5, 4), (8, 8), (9, 12), (16, 7)]
+
+    def check(self, layer):
+        for impl in ['folded', 'separable']:
+            fast = networks.set_blur_impl(torch.nn.Sequential(copy.deepcopy(layer)), impl)[0]
+            self.assertEqual(list(fast.state_dict()), list(layer.state_dict()))
+            for h, w in self.sizes:
+                x = torch.randn(2, 3, h, w)
+                try:
+                    expected = layer(x)
+                except RuntimeError:  # too small for the reference pad
+                    continue
+                out = fast(x)
+                self.assertEqual(out.shape, expected.shape, (impl, layer, h, w))
+                self.assertLess((out - expected).abs().max().item(), 1e-5, (impl, layer, h, w))
+
+    def test_downsample(self):
+        torch.manual_seed(0)
+        for filt_size, pad_type, stride, pad_off in itertools.product(range(1, 8), ['reflect', 'repl', 'zero'], [2, 3], [0, 1]):
+            self.check(networks.Downsample(3, pad_type, filt_size, stride, pad_off))
+
+    def test_upsample(self):
+        torch.manual_seed(0)
+        for filt_size, pad_type, stride in itertools.product(range(1, 8), ['reflect', 'repl', 'zero'], [2, 3]):
+            self.check(networks.Upsample(3, pad_type, filt_size, stride))
+
+
+if __name__ == '__main__':
+    unittest.main()
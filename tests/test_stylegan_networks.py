@@ -0,0 +1,43 @@
+import itertools
+import unittest
+
+import torch
+
+from models import stylegan_networks
+
+
+class Upfirdn2dParityTest(unittest.TestCase):
+    """upfirdn2d_grouped against upfirdn2d_native."""
+
+    def check(self, kernel, *args):
+        x = torch.randn(2, 3, 9, 12)
+        expected = stylegan_networks.upfirdn2d_native(x, kernel, *args)
+        out = stylegan_networks.upfirdn2d_grouped(x, kernel, *args)
+        self.assertEqual(out.shape, expected.shape, args)
+        if expected.numel() > 0:
+            self.assertLess((out - expected).abs().max().item(), 1e-5, args)
+
+    def test_grid(self):
+        torch.manual_seed(0)
+        for size, up, down, pad0, pad1 in itertools.product(range(1, 5), range(1, 4), range(1, 4), range(-2, 4), range(-2, 4)):
+            kernel = stylegan_networks.make_kernel(torch.randint(1, 5, (size,)).tolist())
+            self.check(kernel, up, up, down, down, pad0, pad1, pad0, pad1)
+
+    def test_different_x_y(self):
+        torch.manual_seed(0)
+        kernel = stylegan_networks.make_kernel([1, 3, 3, 1])
+        self.check(kernel, 2, 1, 1, 2, 1, 2, 0, -1)
+        self.check(kernel, 1, 3, 2, 1, -2, 0, 3, 1)
+
+    def test_layers(self):
+        torch.manual_seed(0)
+        x = torch.randn(2, 4, 8, 8)
+        for layer in [stylegan_networks.Upsample([1, 3, 3, 1]), stylegan_networks.Downsample([1, 3, 3, 1]),
+                      stylegan_networks.Blur([1, 3, 3, 1], pad=(2, 1), upsample_factor=2), stylegan_networks.Blur([1, 3, 3, 1], pad=(1, 1))]:
+            expected = layer(x)
+            stylegan_networks.set_upfirdn2d_impl(layer, 'grouped')
+            self.assertLess((layer(x) - expected).abs().max().item(), 1e-5, layer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""This module runs an ONNX export of the generator with onnxruntime, without importing torch.
+
+The pre- and post-processing match the test dataset transform (see data/base_dataset.get_transform)
+and util.tensor2im, so a serving process only needs numpy, PIL and onnxruntime:
+
+    generator = OnnxGenerator('./checkpoints/ct2us_qt/265_net_G.onnx')
+    us = generator.generate([ct_sample])[0]   # uint8 (H, W, 3) image
+"""
+import numpy as np
+from PIL import Image
+import onnxruntime
+
+
+def preprocess(images, size=256, input_nc=3):
+    """Return a list of CT samples as the normalised (N, input_nc, size, size) float32 input of the generator.
+
+    Parameters:
+        images (list or numpy array) -- 2D grayscale images, uint8 or float in [0, 1]
+        size (int)                   -- crop_size of the model; images are resized to it (bicubic)
+        input_nc (int)               -- number of input channels (3: the grayscale image is repeated)
+    """
+    batch = []
+    for image in images:
+        if image.dtype != np.uint8:
+            image = (image * 255).astype(np.uint8)
+        image = Image.fromarray(image).convert('RGB' if input_nc == 3 else 'L').resize((size, size), Image.BICUBIC)
+        image = np.asarray(image, dtype=np.float32).reshape(size, size, -1).transpose(2, 0, 1)
+        batch.append((image / 255 - 0.5) / 0.5)
+    return np.stack(batch).astype(np.float32)
+
+
+def postprocess(outputs):
+    """Convert (N, C, H, W) outputs in [-1, 1] to a list of uint8 (H, W, 3) images, like util.tensor2im."""
+    images = []
+    for output in np.clip(outputs, -1.0, 1.0):
+        if output.shape[0] == 1:
+            output = np.tile(output, (3, 1, 1))
+        images.append(((np.transpose(output, (1, 2, 0)) + 1) / 2.0 * 255.0).astype(np.uint8))
+    return images
+
+
+class OnnxGenerator():
+    """Run the ONNX export of a generator on the CPU execution provider of onnxruntime."""
+
+    def __init__(self, path, threads=0, size=256, input_nc=3):
+        """
+        Parameters:
+            path (str)     -- the .onnx file written by models.export.export_onnx
+            threads (int)  -- intra-op threads of onnxruntime (0: onnxruntime's default)
+            size (int)     -- crop_size of the model, used by <generate>
+            input_nc (int) -- number of input channels of the model
+        """
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.size = size
+        self.input_nc = input_nc
+
+    def __call__(self, batch):
+        """Run the generator on a normalised (N, C, H, W) float32 array and return its (N, C, H, W) output."""
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+    def generate(self, images, batch_size=8):
+        """Return the uint8 US images generated from a list of CT samples (see <preprocess>), in order."""
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            outputs += postprocess(self(preprocess(images[start:start+batch_size], self.size, self.input_nc)))
+        return outputs